@@ -21,6 +21,15 @@ from db import Base
 
 target_metadata = Base.metadata
 
+
+def include_name(name, type_, parent_names):
+    """skip the fts5 song index and its shadow tables, see db.SONG_FTS_DDL,
+    and the tables the migrations keep for their own bookkeeping"""
+    if type_ == "table":
+        return not name.startswith(("song_fts", "alembic_"))
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -43,6 +52,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -65,7 +75,11 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
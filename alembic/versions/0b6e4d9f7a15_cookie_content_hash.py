@@ -0,0 +1,43 @@
+"""cookie content hash
+
+Revision ID: 0b6e4d9f7a15
+Revises: f3a8c61d2b94
+Create Date: 2024-04-25 16:40:08.227951
+
+"""
+import hashlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b6e4d9f7a15'
+down_revision: Union[str, None] = 'f3a8c61d2b94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('cookie', sa.Column('content_hash', sa.String(), nullable=True))
+    # backfill, a content stored twice keeps the hash on its oldest row only
+    conn = op.get_bind()
+    seen = set()
+    rows = conn.execute(sa.text("SELECT id, content FROM cookie ORDER BY id"))
+    for cookie_id, content in rows.fetchall():
+        content_hash = hashlib.sha256((content or "").strip().encode()).hexdigest()
+        if content_hash in seen:
+            continue
+        seen.add(content_hash)
+        conn.execute(
+            sa.text("UPDATE cookie SET content_hash = :h WHERE id = :id"),
+            {"h": content_hash, "id": cookie_id},
+        )
+    op.create_index('ix_cookie_content_hash', 'cookie', ['content_hash'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_cookie_content_hash', table_name='cookie')
+    with op.batch_alter_table('cookie') as batch_op:
+        batch_op.drop_column('content_hash')
@@ -0,0 +1,87 @@
+"""user roles and hot query indexes
+
+Revision ID: 5d92a7e3c1f8
+Revises: 0b6e4d9f7a15
+Create Date: 2024-04-26 09:18:31.704126
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d92a7e3c1f8'
+down_revision: Union[str, None] = '0b6e4d9f7a15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# tables created by an upgrade, so a downgrade leaves hand made ones alone
+created_table = sa.table(
+    'alembic_created', sa.column('revision', sa.String), sa.column('name', sa.String)
+)
+
+
+def upgrade() -> None:
+    # user and roles were created by hand on existing installs, keep those
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    created = [name for name in ('roles', 'user') if name not in tables]
+    if created and 'alembic_created' not in tables:
+        op.create_table('alembic_created',
+        sa.Column('revision', sa.String(length=32), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('revision', 'name')
+        )
+    if created:
+        op.bulk_insert(
+            created_table, [{'revision': revision, 'name': name} for name in created]
+        )
+    if 'roles' not in tables:
+        op.create_table('roles',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('permissions', sa.Integer(), nullable=False),
+        sa.Column('name_enum', sa.Enum('User', 'Admin', 'Root', name='role_name'), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'user' not in tables:
+        op.create_table('user',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tg_id', sa.String(), nullable=True),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('role_id', sa.Integer(), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('updated', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['role_id'], ['roles.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('tg_id')
+        )
+    else:
+        # a hand made user table may lack the unique tg_id of the model
+        inspector = sa.inspect(op.get_bind())
+        indexed = [
+            i['column_names']
+            for i in inspector.get_indexes('user')
+            + inspector.get_unique_constraints('user')
+        ]
+        if ['tg_id'] not in indexed:
+            op.create_index('ix_user_tg_id', 'user', ['tg_id'], unique=False)
+    op.create_index('ix_cookie_available', 'cookie', ['session_expired'], unique=False, sqlite_where=sa.text('left_counts > 0 AND is_working = 0 AND is_valid = 1'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_cookie_available', table_name='cookie')
+    op.execute('DROP INDEX IF EXISTS ix_user_tg_id')
+    bind = op.get_bind()
+    if 'alembic_created' not in sa.inspect(bind).get_table_names():
+        return
+    created = bind.execute(
+        sa.select(created_table.c.name).where(created_table.c.revision == revision)
+    ).scalars().all()
+    for name in ('user', 'roles'):
+        if name in created:
+            op.drop_table(name)
+    op.execute(created_table.delete().where(created_table.c.revision == revision))
+    if not bind.execute(sa.select(sa.func.count()).select_from(created_table)).scalar():
+        op.drop_table('alembic_created')
@@ -0,0 +1,51 @@
+"""song full text search
+
+Revision ID: 9a4c7e1d3b52
+Revises: 5d92a7e3c1f8
+Create Date: 2024-04-27 10:42:15.380917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4c7e1d3b52'
+down_revision: Union[str, None] = '5d92a7e3c1f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # autogenerate does not know fts5, song_fts* is excluded in env.py
+    op.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS song_fts USING fts5(name, lyric, "
+        "content='song', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        "CREATE TRIGGER IF NOT EXISTS song_fts_ai AFTER INSERT ON song BEGIN "
+        "INSERT INTO song_fts(rowid, name, lyric) VALUES (new.id, new.name, new.lyric); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER IF NOT EXISTS song_fts_ad AFTER DELETE ON song BEGIN "
+        "INSERT INTO song_fts(song_fts, rowid, name, lyric) "
+        "VALUES ('delete', old.id, old.name, old.lyric); END"
+    )
+    op.execute(
+        "CREATE TRIGGER IF NOT EXISTS song_fts_au AFTER UPDATE OF name, lyric ON song "
+        "BEGIN INSERT INTO song_fts(song_fts, rowid, name, lyric) "
+        "VALUES ('delete', old.id, old.name, old.lyric); "
+        "INSERT INTO song_fts(rowid, name, lyric) VALUES (new.id, new.name, new.lyric); "
+        "END"
+    )
+    # index the songs stored so far
+    op.execute("INSERT INTO song_fts(song_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS song_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS song_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS song_fts_ai")
+    op.execute("DROP TABLE IF EXISTS song_fts")
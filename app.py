@@ -4,14 +4,25 @@
 # @FileName : app.py
 # Created by; Andy963
 import asyncio
+import secrets
+import signal
 
 from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import config
+from db import adb
 from cmd_router import cmd_router, menus
-from utils.tasks import update_cookie_left_count, update_session_date, \
-    notify_session_expire
+from utils.coordination import coordinator, leader
+from utils.download import close_http_session
+from utils.generation import generation_queue
+from utils.loop_monitor import loop_monitor
+from utils.metrics import MetricsServer
+from utils.session_cache import client_cache
+from utils.tasks import probe_cookie_health, reconcile_credits
+from utils.transport import transport
 
 # Bot token can be obtained via https://t.me/BotFather
 
@@ -22,11 +33,15 @@ dp = Dispatcher()
 dp.include_router(cmd_router)
 
 
-async def telegram_bot() -> None:
-    bot = Bot(config.telegram_token)
-    scheduler = AsyncIOScheduler(timezone="Asia/Shanghai")
+scheduler = AsyncIOScheduler(timezone="Asia/Shanghai")
+metrics_server = MetricsServer(config.metrics_host, config.metrics_port)
+
+
+async def on_startup(bot: Bot):
+    # with several bot workers only the leader runs the cron jobs
+    leader.start()
     scheduler.add_job(
-        update_session_date,
+        leader.wrap(probe_cookie_health),
         "cron",
         hour="3",
         misfire_grace_time=600,
@@ -35,27 +50,83 @@ async def telegram_bot() -> None:
         ],
     )
     scheduler.add_job(
-        update_cookie_left_count,
-        "cron",
-        hour="5",
-        misfire_grace_time=600,
-        args=[
-            bot,
-        ],
-    )
-    scheduler.add_job(
-        notify_session_expire,
-        "cron",
-        hour="6",
+        leader.wrap(reconcile_credits),
+        "interval",
+        minutes=config.credit_reconcile_minutes,
         misfire_grace_time=600,
-        args=[
-            bot,
-        ],
     )
     scheduler.start()
     # set bot menu
     await bot.set_my_commands(menus)
-    await dp.start_polling(bot)
+    await generation_queue.start(bot)
+    if config.metrics_enabled:
+        await metrics_server.start()
+    if config.loop_monitor_enabled:
+        loop_monitor.start()
+
+
+async def on_shutdown():
+    scheduler.shutdown(wait=False)
+    await generation_queue.stop()
+    await metrics_server.stop()
+    await loop_monitor.stop()
+    await leader.stop()
+    await coordinator.close()
+    await client_cache.close()
+    await transport.close()
+    await close_http_session()
+    await adb.close()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+def webhook_secret() -> str:
+    """the configured secret_token, made up for a lone worker which registers
+    the webhook itself; anybody could post updates to an unchecked endpoint"""
+    if config.webhook_secret:
+        return config.webhook_secret
+    if config.webhook_url and not coordinator.shared:
+        return secrets.token_urlsafe(32)
+    raise SystemExit("webhook mode needs webhook.secret_token in config.yaml")
+
+
+async def run_webhook(bot: Bot):
+    """serve updates on aiohttp until SIGINT/SIGTERM, then shut down gracefully"""
+    secret = webhook_secret()
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(
+        app, path=config.webhook_path
+    )
+    # emits dp startup/shutdown together with the aiohttp app
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.webhook_host, config.webhook_port)
+    await site.start()
+    if config.webhook_url:
+        await bot.set_webhook(
+            config.webhook_url.rstrip("/") + config.webhook_path,
+            secret_token=secret,
+        )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def telegram_bot() -> None:
+    bot = Bot(config.telegram_token)
+    if config.webhook_enabled:
+        await run_webhook(bot)
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/22
+# @FileName : fake_suno.py
+# Created by; Andy963
+import asyncio
+import random
+import time
+import uuid
+from http.cookies import SimpleCookie
+
+from aiohttp import web
+
+# payload {"exp": 4102444800}, the jwt never expires during a benchmark
+FAKE_JWT = "header.eyJleHAiOjQxMDI0NDQ4MDB9.signature"
+
+
+class FakeSuno:
+    """Local stand-in for the clerk, studio-api and cdn endpoints.
+
+    Every response waits the configured delay, generate, feed and cdn requests
+    fail with `fail_rate`. A clip completes `ready_after` seconds (+-20%) after
+    generate; accounts are told apart by the `__client` cookie and start with
+    `credits` credits each.
+    """
+
+    def __init__(
+        self,
+        auth_delay: float = 0.05,
+        api_delay: float = 0.1,
+        generate_delay: float = 1,
+        ready_after: float = 5,
+        cdn_delay: float = 0.2,
+        fail_rate: float = 0,
+        credits: int = 10000,
+        clip_size: int = 64 * 1024,
+    ):
+        self.auth_delay = auth_delay
+        self.api_delay = api_delay
+        self.generate_delay = generate_delay
+        self.ready_after = ready_after
+        self.cdn_delay = cdn_delay
+        self.fail_rate = fail_rate
+        self.credits = credits
+        self.clip = b"\xff\xfb" * (clip_size // 2)
+        self.requests = {}  # endpoint -> count
+        self._credits = {}  # account -> credits left
+        self._clips = {}  # clip id -> ready at
+        self._runner = None
+
+    @staticmethod
+    def _account(request: web.Request) -> str:
+        cookie = SimpleCookie()
+        cookie.load(request.headers.get("Cookie", ""))
+        morsel = cookie.get("__client")
+        return morsel.value if morsel else ""
+
+    async def _handle(self, name: str, delay: float, fail: bool = False):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        await asyncio.sleep(delay)
+        if fail and random.random() < self.fail_rate:
+            raise web.HTTPServiceUnavailable()
+
+    async def client(self, request: web.Request) -> web.Response:
+        await self._handle("client", self.auth_delay)
+        expire_at = int((time.time() + 7 * 86400) * 1000)
+        return web.json_response(
+            {
+                "response": {
+                    "last_active_session_id": f"sess_{self._account(request)}",
+                    "sessions": [{"expire_at": expire_at}],
+                }
+            }
+        )
+
+    async def tokens(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._handle("tokens", self.auth_delay)
+        return web.json_response({"jwt": FAKE_JWT})
+
+    async def billing(self, request: web.Request) -> web.Response:
+        await self._handle("billing", self.api_delay)
+        left = self._credits.setdefault(self._account(request), self.credits)
+        return web.json_response({"total_credits_left": left})
+
+    async def generate(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._handle("generate", self.generate_delay, fail=True)
+        account = self._account(request)
+        left = self._credits.setdefault(account, self.credits)
+        if left < 10:
+            raise web.HTTPPaymentRequired()
+        self._credits[account] = left - 10
+        clips = []
+        for _ in range(2):
+            clip_id = str(uuid.uuid4())
+            delay = self.ready_after * random.uniform(0.8, 1.2)
+            self._clips[clip_id] = time.monotonic() + delay
+            clips.append({"id": clip_id, "status": "submitted"})
+        return web.json_response({"clips": clips})
+
+    async def feed(self, request: web.Request) -> web.Response:
+        await self._handle("feed", self.api_delay, fail=True)
+        now = time.monotonic()
+        clips = []
+        for clip_id in request.query.get("ids", "").split(","):
+            ready_at = self._clips.get(clip_id)
+            if ready_at is None:
+                continue
+            clips.append(
+                {
+                    "id": clip_id,
+                    "title": f"Bench {clip_id[:8]}",
+                    "status": "complete" if ready_at <= now else "streaming",
+                    "metadata": {"prompt": "[Verse]\nla la la"},
+                }
+            )
+        return web.json_response(clips)
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        await self._handle("cdn", self.cdn_delay, fail=True)
+        name = request.match_info["name"]
+        content_type = "audio/mpeg" if name.endswith(".mp3") else "video/mp4"
+        return web.Response(body=self.clip, content_type=content_type)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/v1/client", self.client)
+        app.router.add_post("/v1/client/sessions/{sid}/tokens", self.tokens)
+        app.router.add_get("/api/billing/info/", self.billing)
+        app.router.add_post("/api/generate/v2/", self.generate)
+        app.router.add_get("/api/feed/", self.feed)
+        app.router.add_get("/cdn/{name}", self.cdn)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> str:
+        """serve in the running loop, return the base url"""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def patch_urls(base: str):
+    """point the bot's suno and cdn urls at a FakeSuno server"""
+    from curl_cffi.const import CurlHttpVersion
+
+    import utils.download
+    import utils.generation
+    import utils.suno
+    import utils.transport
+
+    # over plain http curl asks for an h2c upgrade, which aiohttp's C parser
+    # rejects on requests with a body
+    utils.transport.transport.http_version = CurlHttpVersion.V1_1
+
+    utils.suno.get_session_url = base + "/v1/client"
+    utils.suno.exchange_token_url = base + "/v1/client/sessions/{sid}/tokens"
+    utils.suno.studio_api_url = base
+    utils.suno.generate_url = base + "/api/generate/v2/"
+    utils.suno.feed_url = base + "/api/feed/?ids={ids}"
+    utils.suno.billing_url = base + "/api/billing/info/"
+    utils.download.cdn_url = base + "/cdn"
+    utils.generation.cdn_url = base + "/cdn"
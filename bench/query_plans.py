@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/26
+# @FileName : query_plans.py
+# Created by; Andy963
+"""Query plans and timings of the hot db queries, without and with indexes.
+
+A scratch db.sqlite is filled with synthetic cookies, users and songs. The SQL
+which AsyncDB actually sends for each hot query is captured once, then run
+with `NOT INDEXED` on its table (the plain schema of the init migration) and
+as is (the indexed schema), printing EXPLAIN QUERY PLAN and the mean time.
+
+    python -m bench.query_plans --cookies 10000 --songs 1000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def populate(path: str, cookies: int, users: int, songs: int, prompts: int):
+    from db import Base, cookie_hash, db
+
+    Base.metadata.create_all(db.engine)
+    db.engine.dispose()
+    now = datetime.now()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "INSERT INTO roles (id, name, permissions, name_enum) "
+        "VALUES (1, 'Admin', 2, 'Admin')"
+    )
+    # only the newest 5% of the cookies have credits left, like an install
+    # which keeps adding accounts while the old ones run dry
+    fresh = int(cookies * 0.95)
+    conn.executemany(
+        "INSERT INTO cookie (content, content_hash, left_counts, is_working, "
+        "is_valid, session_expired, remark, created, updated) "
+        "VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)",
+        (
+            (
+                f"__client=bench{i}",
+                cookie_hash(f"__client=bench{i}"),
+                random.randint(1, 50) if i >= fresh else 0,
+                i % 40 == 1,
+                i % 10 != 3,
+                now + timedelta(days=random.randint(-3, 7)),
+                now,
+                now,
+            )
+            for i in range(cookies)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO user (tg_id, name, role_id, created, updated) "
+        "VALUES (?, ?, 1, ?, ?)",
+        ((str(100000 + i), f"user{i}", now, now) for i in range(users)),
+    )
+    conn.executemany(
+        "INSERT INTO song (name, lyric, audio_url, video_url, prompt, mv, file_ids, "
+        "created, updated) VALUES (?, ?, '[]', '[]', ?, 'chirp-v3-0', '[]', ?, ?)",
+        (
+            (
+                f"song {i}",
+                f"lyric of song {i}",
+                f"prompt {random.randrange(prompts)}",
+                now - timedelta(minutes=songs - i),
+                now,
+            )
+            for i in range(songs)
+        ),
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+async def capture(users: int) -> list:
+    """[(name, sql, params)] of the hot AsyncDB queries"""
+    from sqlalchemy import event
+
+    from db import adb
+
+    captured = []
+    current = [None]
+
+    @event.listens_for(adb.engine.sync_engine, "before_cursor_execute")
+    def _capture(conn, cursor, statement, params, context, executemany):
+        if current[0] is not None:
+            captured.append((current[0], statement, params))
+
+    cookies = await adb.get_all_cookie()
+    newest = cookies[-1].content
+    queries = [
+        ("get_alive_cookie", adb.get_alive_cookie()),
+        ("get_left_count", adb.get_left_count()),
+        ("get_cookie_by_content", adb.get_cookie_by_content(newest)),
+        ("get_user", adb.get_user(str(100000 + users // 2))),
+        (
+            "find_song",
+            adb.find_song(
+                "prompt 42", "chirp-v3-0", since=datetime.now() - timedelta(days=1)
+            ),
+        ),
+    ]
+    for name, query in queries:
+        current[0] = name
+        await query
+    current[0] = None
+    await adb.close()
+    return captured
+
+
+def not_indexed(sql: str) -> str:
+    """forbid any index on the queried table, as in the unindexed schema"""
+    return re.sub(r"FROM (\w+)( |$)", r"FROM \1 NOT INDEXED\2", sql, count=1)
+
+
+def measure(conn: sqlite3.Connection, sql: str, params, repeat: int) -> tuple:
+    plan = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(sql, params).fetchall()
+    return plan, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cookies", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--songs", type=int, default=1000000)
+    parser.add_argument("--prompts", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--workdir", help="defaults to a temporary directory")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="suno-plans-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path = os.path.join(workdir, "db.sqlite")
+
+    start = time.perf_counter()
+    populate(path, args.cookies, args.users, args.songs, args.prompts)
+    print(
+        f"{args.cookies} cookies, {args.users} users, {args.songs} songs "
+        f"populated in {time.perf_counter() - start:.1f}s ({workdir})"
+    )
+    conn = sqlite3.connect(path)
+    for name, sql, params in asyncio.run(capture(args.users)):
+        print(f"\n{name}: {' '.join(sql.split())[:160]}")
+        for label, query in (("no index", not_indexed(sql)), ("indexed", sql)):
+            plan, seconds = measure(conn, query, params, args.repeat)
+            print(f"  {label:<9} {seconds * 1000:9.3f}ms  {'; '.join(plan)}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/22
+# @FileName : run.py
+# Created by; Andy963
+"""Offline /sing benchmark, no credits are spent.
+
+The bot runs against a local FakeSuno server in a scratch directory (own
+db.sqlite and logs). N users each send /sing through the real dispatcher and
+cmd_router, waiting for both clips before the next one, with M cookies in the
+pool. Telegram is replaced by an aiogram session which answers every call.
+
+    python -m bench.run --users 20 --cookies 4 --songs 3 --ready-after 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendAudio, SendMessage
+from aiogram.types import Audio, Chat, Message, Update, User as TgUser
+
+from bench.fake_suno import FakeSuno, patch_urls
+
+CLIPS_PER_SONG = 2
+FAILED_TEXT = "get songs failed"
+
+
+class MockSession(BaseSession):
+    """answers telegram api calls locally and reports audios per chat"""
+
+    def __init__(self, on_message, upload_delay: float = 0):
+        super().__init__()
+        self.on_message = on_message
+        self.upload_delay = upload_delay
+        self.calls = {}
+        self._message_id = 0
+
+    def _message(self, chat_id, **kwargs) -> Message:
+        self._message_id += 1
+        return Message(
+            message_id=self._message_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            **kwargs,
+        )
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if isinstance(method, SendAudio):
+            if not isinstance(method.audio, str):
+                await asyncio.sleep(self.upload_delay)
+            file_id = f"file_{self._message_id}"
+            msg = self._message(
+                method.chat_id,
+                audio=Audio(file_id=file_id, file_unique_id=file_id, duration=60),
+            )
+            self.on_message(method.chat_id, msg)
+            return msg
+        if isinstance(method, SendMessage):
+            msg = self._message(method.chat_id, text=method.text)
+            self.on_message(method.chat_id, msg)
+            return msg
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def loop_lag(samples: list, interval: float = 0.05):
+    """record how late the event loop wakes up a sleeping task"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+def setup_db(users: int, cookies: int):
+    from db import Base, Cookie, Role, User, db
+
+    Base.metadata.create_all(db.engine)
+    with db.Session() as s:
+        role = Role(name="Admin", permissions=Role.ADMIN, name_enum="Admin")
+        s.add(role)
+        s.flush()
+        for i in range(users):
+            s.add(User(tg_id=str(1000 + i), name=f"bench{i}", role_id=role.id))
+        for i in range(cookies):
+            s.add(Cookie(content=f"__client=bench{i}", left_counts=1000))
+        s.commit()
+
+
+async def bench(args) -> dict:
+    setup_db(args.users, args.cookies)
+    fake = FakeSuno(
+        auth_delay=args.auth_delay,
+        api_delay=args.api_delay,
+        generate_delay=args.generate_delay,
+        ready_after=args.ready_after,
+        cdn_delay=args.cdn_delay,
+        fail_rate=args.fail_rate,
+    )
+    patch_urls(await fake.start(port=args.port))
+
+    from cmd_router import cmd_router
+    from db import adb
+    from utils.cookie_pool import cookie_pool
+    from utils.download import cdn_stats, close_http_session
+    from utils.generation import generation_queue
+    from utils.metrics import db_query_seconds, stage_seconds
+    from utils.readiness import clip_tracker
+    from utils.session_cache import client_cache
+    from utils.transport import transport
+
+    clip_tracker.min_interval = args.poll_interval
+    generation_queue.base_workers = args.workers
+    cookie_pool.max_concurrency = args.cookie_concurrency
+
+    waiters = {}  # chat_id -> [future, audios received]
+
+    def on_message(chat_id, msg: Message):
+        waiter = waiters.get(chat_id)
+        if waiter is None or waiter[0].done():
+            return
+        if msg.audio is not None:
+            waiter[1] += 1
+            if waiter[1] >= CLIPS_PER_SONG:
+                waiter[0].set_result(True)
+        elif msg.text and msg.text.startswith(FAILED_TEXT):
+            waiter[0].set_result(False)
+
+    dp = Dispatcher()
+    dp.include_router(cmd_router)
+    bot = Bot("123456:bench", session=MockSession(on_message, args.upload_delay))
+    await generation_queue.start(bot)
+
+    latencies, failed = [], 0
+    update_id = 0
+
+    async def user(index: int):
+        nonlocal update_id, failed
+        tg_id = 1000 + index
+        for n in range(args.songs):
+            update_id += 1
+            waiters[tg_id] = [asyncio.get_running_loop().create_future(), 0]
+            update = Update(
+                update_id=update_id,
+                message=Message(
+                    message_id=update_id,
+                    date=datetime.now(),
+                    chat=Chat(id=tg_id, type="private"),
+                    from_user=TgUser(id=tg_id, is_bot=False, first_name="bench"),
+                    text=f"/sing bench song {index} {n}",
+                ),
+            )
+            start = time.perf_counter()
+            await dp.feed_update(bot, update)
+            try:
+                ok = await asyncio.wait_for(waiters[tg_id][0], args.timeout)
+            except asyncio.TimeoutError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failed += 1
+
+    lag = []
+    lag_task = asyncio.create_task(loop_lag(lag))
+    start = time.perf_counter()
+    await asyncio.gather(*[user(i) for i in range(args.users)])
+    elapsed = time.perf_counter() - start
+    lag_task.cancel()
+
+    await generation_queue.stop()
+    await client_cache.close()
+    await transport.close()
+    await close_http_session()
+    await fake.stop()
+    await adb.close()
+
+    return {
+        "elapsed": elapsed,
+        "songs": len(latencies),
+        "failed": failed,
+        "latencies": latencies,
+        "lag": lag,
+        "stages": stage_seconds.summary(),
+        "db": db_query_seconds.summary(),
+        "requests": fake.requests,
+        "telegram": bot.session.calls,
+        "connections": {"suno": transport.stats(), "cdn": cdn_stats.stats()},
+    }
+
+
+def report(args, r: dict):
+    lat, lag = r["latencies"], r["lag"]
+    print(
+        f"{args.users} users x {args.songs} songs, {args.cookies} cookies, "
+        f"{args.workers} workers, fail rate {args.fail_rate}"
+    )
+    print(f"  elapsed         {r['elapsed']:.1f}s")
+    print(f"  songs           {r['songs']} ok, {r['failed']} failed")
+    print(f"  songs/minute    {r['songs'] / r['elapsed'] * 60:.1f}")
+    if lat:
+        print(
+            f"  latency         p50 {percentile(lat, 0.5):.2f}s  "
+            f"p95 {percentile(lat, 0.95):.2f}s  max {max(lat):.2f}s"
+        )
+    if lag:
+        print(
+            f"  event loop lag  mean {statistics.mean(lag) * 1000:.1f}ms  "
+            f"p95 {percentile(lag, 0.95) * 1000:.1f}ms  max {max(lag) * 1000:.1f}ms"
+        )
+    print("  stages (count / mean s):")
+    for labels, (count, total, _) in sorted(r["stages"].items()):
+        print(f"    {labels[0][1]:<10} {count:>6} / {total / count:.3f}")
+    print("  db contention (count / mean ms / p95 bucket s), slowest first:")
+    rows = sorted(r["db"].items(), key=lambda i: i[1][1] / i[1][0], reverse=True)
+    for labels, (count, total, p95) in rows[:8]:
+        method = dict(labels)["method"]
+        print(f"    {method:<22} {count:>6} / {total / count * 1000:.1f} / {p95}")
+    print(f"  fake suno requests  {r['requests']}")
+    print(f"  telegram calls      {r['telegram']}")
+    for pool, stats in r["connections"].items():
+        print(
+            f"  {pool + ' connections':<19} {stats['requests']} requests, "
+            f"{stats['connects']} new, reuse {stats['reuse']:.0%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--cookies", type=int, default=2)
+    parser.add_argument("--songs", type=int, default=2, help="songs per user")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cookie-concurrency", type=int, default=1)
+    parser.add_argument("--auth-delay", type=float, default=0.05)
+    parser.add_argument("--api-delay", type=float, default=0.1)
+    parser.add_argument("--generate-delay", type=float, default=1)
+    parser.add_argument("--ready-after", type=float, default=5)
+    parser.add_argument("--cdn-delay", type=float, default=0.2)
+    parser.add_argument("--upload-delay", type=float, default=0.2)
+    parser.add_argument("--fail-rate", type=float, default=0)
+    parser.add_argument("--poll-interval", type=float, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="per song")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workdir", help="defaults to a temporary directory")
+    args = parser.parse_args()
+
+    # db.sqlite and ./logs are relative, keep them out of the real bot's dir
+    workdir = args.workdir or tempfile.mkdtemp(prefix="suno-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = asyncio.run(bench(args))
+    report(args, result)
+    print(f"  workdir             {workdir}")
+    if not result["songs"]:
+        sys.exit(f"every song failed, see {workdir}/logs")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,33 +3,50 @@
 # @Date     : 2024/3/25
 # @FileName : cmd_router.py
 # Created by; Andy963
-import time
-from pathlib import Path
+import asyncio
+import hashlib
+from collections import OrderedDict
 
-from aiogram import types, Router, enums
+from aiogram import types, Router
 from aiogram.filters import Command
-from aiogram.types import (
-    BotCommand,
-    FSInputFile,
-)
-from requests import get
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
 
-from db import db
-from utils.logger import FileSplitLogger
-from utils.suno import SongsGen
-from utils.tasks import update_cookie_left_count, update_session_date
+import config
+from db import adb
+from utils.cookie_import import import_cookies, parse_cookies, summary
+from utils.download import cdn_stats
+from utils.generation import generation_queue, send_song
+from utils.logger import FileSplitLogger, LogContextMiddleware
+from utils.loop_monitor import loop_monitor
+from utils.metrics import stats_text
+from utils.permission import PermissionMiddleware, perm_cache
+from utils.prompt_cache import prompt_cache
+from utils.ratelimit import breaker
+from utils.sing_batch import SingBatch, parse_prompts
+from utils.tasks import probe_cookie_health
+from utils.transport import transport
 
 cmd_router = Router()
+cmd_router.message.middleware(LogContextMiddleware())
+cmd_router.message.middleware(PermissionMiddleware())
+cmd_router.callback_query.middleware(LogContextMiddleware())
+cmd_router.callback_query.middleware(PermissionMiddleware())
 bot_logger = FileSplitLogger("./logs/bot.log").logger
 menu_list = [
     ("/start", "Start"),
-    ("/sing", "sing a song"),
-    ("/cookie", "add Cookie"),
+    ("/sing", "sing a song, or many with one prompt per line or a .txt file"),
+    ("/cookie", "add cookies, one per line or as a .txt/.jsonl file"),
     ("/count", "get left count"),
-    ("/update_left", "update_left_count"),
-    ("/update_expire", "update_expire_date"),
+    ("/resend", "send a stored song again by id"),
+    ("/search", "search stored songs by name and lyric"),
+    ("/probe", "update cookies left count and expire date"),
+    ("/stats", "show bot metrics"),
 ]
 menus = [BotCommand(command=cmd, description=dsp) for cmd, dsp in menu_list]
+MAX_UPLOAD_FILE = 5 * 1024 * 1024
+SEARCH_PAGE_SIZE = 5
+MAX_SEARCHES = 1000
 
 
 @cmd_router.message(Command("start"))
@@ -37,151 +54,239 @@ async def start(message: types.Message):
     await message.answer("Hello, this a  suno bot.")
 
 
-@cmd_router.message(Command("count"))
+@cmd_router.message(Command("count"), flags={"admin": True})
 async def count(message: types.Message):
-    tg_id = message.from_user.id
-    user = db.get_user(tg_id)
-    if not user or not user.has_admin_permission():
-        await message.answer("You do not have permission to use this command")
-        return
-    ct = db.get_left_count()
+    ct = await adb.get_left_count()
     await message.answer(
         f'Currently you can create at most {ct} song{"s" if ct > 1 else ""}.'
     )
 
 
-@cmd_router.message(Command("cookie"))
+def split_text(lines: list, limit: int = 4000) -> list:
+    """join lines into messages below telegram's 4096 characters"""
+    chunks, chunk = [], ""
+    for line in lines:
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def command_text(message: types.Message, command: str):
+    """the text after the command, or the content of an uploaded file, None
+    when the file was rejected"""
+    if message.document:
+        if message.document.file_size > MAX_UPLOAD_FILE:
+            await message.answer("File is too large")
+            return None
+        data = await message.bot.download(message.document)
+        return data.read().decode("utf-8", errors="ignore")
+    return message.text.split(command, 1)[-1]
+
+
+@cmd_router.message(Command("cookie"), flags={"admin": True})
 async def new_cookie(message: types.Message):
-    tg_id = message.from_user.id
-    user = db.get_user(tg_id)
-    if not user or not user.has_admin_permission():
-        await message.answer("You do not have permission to use this command")
+    """/cookie with one cookie per line, or as the caption of a .txt/.jsonl"""
+    text = await command_text(message, "/cookie")
+    if text is None:
         return
-    text = message.text
-    cookie = text.split("/cookie")[-1]
-    cookie = cookie.strip()
-    if not cookie or len(cookie) < 10:
+    contents = parse_cookies(text)
+    if not contents:
         await message.answer("Cookie is invalid")
         return
-    if db.get_cookie_by_content(cookie):
-        await message.answer("Cookie already exists")
+    if len(contents) > 1:
+        await message.answer(f"Validating {len(contents)} cookies...")
+    try:
+        results = await import_cookies(contents)
+    except Exception as e:
+        bot_logger.error(f"import cookies failed with: {e}")
+        await message.answer("import cookies failed please check the log")
         return
-    db.create_cookie(content=cookie)
-    await message.answer("Cookie saved")
+    lines = [str(r) for r in results] + [f"Cookie import: {summary(results)}"]
+    for text in split_text(lines):
+        await message.answer(text)
+
+
+@cmd_router.message(
+    Command("probe", "update_left", "update_expire"), flags={"admin": True}
+)
+async def probe_cookie_status(message: types.Message):
+    await probe_cookie_health(message.bot)
 
 
-@cmd_router.message(Command("update_left"))
-async def update_cookie_counts(message: types.Message):
-    tg_id = message.from_user.id
-    user = db.get_user(tg_id)
-    if not user or not user.has_admin_permission():
-        await message.answer("You do not have permission to use this command")
+@cmd_router.message(Command("sing"), flags={"admin": True})
+async def new_song(message: types.Message):
+    text = await command_text(message, "/sing")
+    if text is None:
+        return
+    prompts = parse_prompts(text)
+    if not prompts:
+        await message.answer("Prompt is invalid")
         return
+    if len(prompts) > 1:
+        await sing_batch(message, prompts)
+        return
+    prompt = prompts[0]
+    job = await generation_queue.submit(message.from_user.id, message.chat.id, prompt)
+    await message.answer(
+        f"Singing... job #{job.id} queued ({len(generation_queue)} waiting)."
+    )
+
 
-    await update_cookie_left_count(message.bot)
+# running batches, referenced until they report
+_batches = set()
 
 
-@cmd_router.message(Command("update_expire"))
-async def update_session_expire_date(message: types.Message):
-    tg_id = message.from_user.id
-    user = db.get_user(tg_id)
-    if not user or not user.has_admin_permission():
-        await message.answer("You do not have permission to use this command")
+async def sing_batch(message: types.Message, prompts: list):
+    if len(prompts) > config.batch_max_prompts:
+        await message.answer(f"At most {config.batch_max_prompts} prompts at once")
         return
+    batch = SingBatch(message.from_user.id, message.chat.id, prompts)
+    text = await batch.submit()
+    # the report scales the queue back, start it before anything else can fail
+    task = asyncio.create_task(report_batch(message, batch))
+    _batches.add(task)
+    task.add_done_callback(_batches.discard)
+    await message.answer(text)
 
-    await update_session_date(message.bot)
 
+async def report_batch(message: types.Message, batch: SingBatch):
+    try:
+        await batch.wait(timeout=config.batch_timeout)
+        for text in split_text(batch.summary()):
+            await message.answer(text)
+    except Exception as e:
+        bot_logger.error(f"batch report failed with: {e}")
 
-@cmd_router.message(Command("sing"))
-async def new_song(message: types.Message):
-    tg_id = message.from_user.id
-    user = db.get_user(tg_id)
-    if not user or not user.has_admin_permission():
-        await message.answer("You do not have permission to use this command")
-        return
-    text = message.text
-    prompt = text.split("/sing")[-1]
-    prompt = prompt.strip()
-    if not prompt or len(prompt) < 2:
-        await message.answer("Prompt is invalid")
-        return
-    await message.answer("Singing...")
-    ck = db.get_alive_cookie()
-    if not ck:
-        await message.answer("Idle cookie is not available")
+
+async def resend(bot, chat_id: int, song_id: int):
+    """send a stored song to chat_id, the error to answer with if it failed"""
+    song = await adb.get_song(song_id)
+    if not song:
+        return f"Song {song_id} does not exist"
+    try:
+        await send_song(bot, song, [chat_id])
+    except Exception as e:
+        bot_logger.error(f"resend song {song_id} failed with: {e}")
+        return "resend song failed please check the log"
+
+
+@cmd_router.message(Command("resend"), flags={"admin": True})
+async def resend_song(message: types.Message):
+    song_id = message.text.split("/resend")[-1].strip()
+    if not song_id.isdigit():
+        await message.answer("Usage: /resend <song id>")
         return
-    sg = SongsGen(ck.content)
-    left_count = sg.get_limit_left()
-    if left_count <= 0:
-        db.update_cookie(ck.id, left_count=0, is_working=False)
-        await message.answer(
-            f"Cookie: {ck.id} is is running out of usage."
-            f"and disabled, please try again."
+    if error := await resend(message.bot, message.chat.id, int(song_id)):
+        await message.answer(error)
+
+
+class SearchPage(CallbackData, prefix="search"):
+    key: str
+    page: int
+
+
+class ResendSong(CallbackData, prefix="resend"):
+    song_id: int
+
+
+# recent search terms by key, callback data is limited to 64 bytes
+_searches = OrderedDict()
+
+
+def remember_search(terms: str) -> str:
+    key = hashlib.sha1(terms.encode()).hexdigest()[:12]
+    _searches[key] = terms
+    _searches.move_to_end(key)
+    while len(_searches) > MAX_SEARCHES:
+        _searches.popitem(last=False)
+    return key
+
+
+async def search_page(terms: str, page: int):
+    """(text, keyboard) of one page of results, a button per song resends it"""
+    total, songs = await adb.search_songs(
+        terms, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE
+    )
+    if not total:
+        return f'No song matches "{terms}"', None
+    pages = -(-total // SEARCH_PAGE_SIZE)
+    lines = [f'{total} songs match "{terms}", page {page + 1}/{pages}']
+    buttons = []
+    for song_id, name, snippet in songs:
+        name = name or "untitled"
+        lines.append(f"\n#{song_id} {name}\n{' '.join(snippet.split())}"[:400])
+        buttons.append(
+            [
+                InlineKeyboardButton(
+                    text=f"Send #{song_id} {name}"[:64],
+                    callback_data=ResendSong(song_id=song_id).pack(),
+                )
+            ]
         )
-        return
-    try:
-        db.update_cookie(ck.id, left_count - 1, is_working=True)
-        song_info = sg.get_songs_info(prompt=prompt)
-        song_name = song_info["song_name"]
-        lyric = song_info["lyric"]
-        song_ids = song_info["song_ids"]
-        audio_urls = [f"https://cdn1.suno.ai/{i}.mp3" for i in song_ids]
-        video_urls = [f"https://cdn1.suno.ai/{i}.mp4" for i in song_ids]
-        db.create_song(
-            name=song_name,
-            lyric=lyric,
-            audio_url=audio_urls,
-            video_url=video_urls,
+    key = remember_search(terms)
+    nav = []
+    if page > 0:
+        nav.append(
+            InlineKeyboardButton(
+                text="« Prev", callback_data=SearchPage(key=key, page=page - 1).pack()
+            )
         )
-        output_dir = "./output"
-        max_retries = 5  # retry to download from suno
-        sleep_time = 60  # sleep time at first time
-        if not Path(output_dir).exists():
-            Path(output_dir).mkdir()
-        time.sleep(sleep_time)
-        for index, url in enumerate(audio_urls, 1):
-            retry_count = 0
-            while retry_count < max_retries:
-                response = get(url, allow_redirects=False, stream=True)
-                if response.status_code == 200:
-                    song_file = (
-                        Path(output_dir) / f"{song_name.replace(' ', '_')}_{index}.mp3"
-                    )
-                    with open(song_file, "wb") as output_file:
-                        for chunk in response.iter_content(chunk_size=1024):
-                            if chunk:
-                                output_file.write(chunk)
-                    # check file size
-                    if song_file.stat().st_size < 1024 or (not song_file.exists()):
-                        bot_logger.warning(
-                            f"Downloaded song {song_name} failed, file size is too small"
-                        )
-                        song_file.unlink()
-                        retry_count += 1
-                        bot_logger.warning(
-                            f"Retrying download for song {song_file.name}, attempt {retry_count}"
-                        )
-                        time.sleep(sleep_time)
-                        sleep_time = max(sleep_time - 10, 10)
-                    else:
-                        af = FSInputFile(song_file, filename=song_file.name)
-                        await message.bot.send_chat_action(
-                            message.chat.id, enums.ChatAction.UPLOAD_VOICE
-                        )
-                        await message.bot.send_audio(
-                            message.chat.id, audio=af, caption=lyric
-                        )
-                        song_file.unlink()
-                        break
-                else:
-                    retry_count += 1
-                    bot_logger.warning(
-                        f"Could not download song, retry attempt {retry_count}"
-                    )
-                    time.sleep(sleep_time)
-                    sleep_time = max(sleep_time - 10, 10)
-    except Exception as e:
-        bot_logger.error(f"get songs failed with: {e}")
-        await message.answer("get songs failed please check the log")
-    finally:
-        db.update_cookie(ck.id, left_count - 1, is_working=False)
+    if page + 1 < pages:
+        nav.append(
+            InlineKeyboardButton(
+                text="Next »", callback_data=SearchPage(key=key, page=page + 1).pack()
+            )
+        )
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@cmd_router.message(Command("search"), flags={"admin": True})
+async def search_songs(message: types.Message):
+    terms = message.text.split("/search")[-1].strip()
+    if not terms:
+        await message.answer("Usage: /search <words of the name or lyric>")
+        return
+    text, markup = await search_page(terms, 0)
+    await message.answer(text, reply_markup=markup)
+
+
+@cmd_router.callback_query(SearchPage.filter(), flags={"admin": True})
+async def search_more(query: types.CallbackQuery, callback_data: SearchPage):
+    terms = _searches.get(callback_data.key)
+    if terms is None or not isinstance(query.message, types.Message):
+        await query.answer("This search expired, please search again")
+        return
+    text, markup = await search_page(terms, callback_data.page)
+    await query.message.edit_text(text, reply_markup=markup)
+    await query.answer()
+
+
+@cmd_router.callback_query(ResendSong.filter(), flags={"admin": True})
+async def resend_match(query: types.CallbackQuery, callback_data: ResendSong):
+    await query.answer("Sending...")
+    chat_id = query.message.chat.id if query.message else query.from_user.id
+    if error := await resend(query.bot, chat_id, callback_data.song_id):
+        await query.bot.send_message(chat_id, error)
+
+
+@cmd_router.message(Command("stats"), flags={"admin": True})
+async def stats(message: types.Message):
+    text = stats_text(
+        {
+            "Queue": len(generation_queue),
+            "Prompt cache": prompt_cache.stats(),
+            "Permission cache": perm_cache.stats(),
+            "Log queues": FileSplitLogger.stats(),
+            "Event loop": loop_monitor.stats(),
+            "Quarantined cookies": breaker.stats(),
+            "Suno connections": transport.stats(),
+            "CDN connections": cdn_stats.stats(),
+        }
+    )
+    await message.answer(text)
@@ -14,3 +14,81 @@ with open(config_dir / "config.yaml", "r") as f:
 
 telegram_token = config_yaml.get("telegram_token")
 bot_id = config_yaml.get("bot_id")
+# how many generations may run on one cookie at the same time
+cookie_concurrency = config_yaml.get("cookie_concurrency", 1)
+# scheduled cookie jobs: cookies checked at the same time and seconds per cookie
+task_concurrency = config_yaml.get("task_concurrency", 20)
+task_timeout = config_yaml.get("task_timeout", 30)
+# async workers consuming the /sing job queue
+generation_workers = config_yaml.get("generation_workers", 4)
+# /sing with several prompts, one per line or in a .txt file: at most
+# batch_max_prompts prompts, the queue grows to one worker per cookie slot up
+# to batch_max_workers, the summary is sent after batch_timeout seconds at most
+batch_max_prompts = config_yaml.get("batch_max_prompts", 100)
+batch_max_workers = config_yaml.get("batch_max_workers", 32)
+batch_timeout = config_yaml.get("batch_timeout", 3600)
+# a /sing failing on its cookie before any credit is spent is retried on up
+# to generation_failover other cookies
+generation_failover = config_yaml.get("generation_failover", 2)
+# upstream requests per second by endpoint, a number or [rate, burst], 0 is
+# unlimited, e.g. rate_limits: {clerk: 5, generate: [2, 5], feed: 5, billing: 5}
+rate_limits = {
+    "clerk": [5, 10],
+    "generate": [2, 5],
+    "feed": [5, 10],
+    "billing": [5, 20],
+    **(config_yaml.get("rate_limits") or {}),
+}
+# keep-alive connections shared by every account's suno client: idle ones
+# kept open and the limit per host (0 is unlimited)
+transport = config_yaml.get("transport") or {}
+transport_max_connections = transport.get("max_connections", 64)
+transport_max_host_connections = transport.get("max_host_connections", 0)
+# breaker_threshold failed responses in a row (401/403/429/5xx) quarantine a
+# cookie for breaker_cooldown seconds, doubled each time it fails again
+breaker_threshold = config_yaml.get("breaker_threshold", 3)
+breaker_cooldown = config_yaml.get("breaker_cooldown", 60)
+# serve a song stored in the last prompt_cache_ttl seconds for the same prompt,
+# 0 disables it; identical prompts in flight share one generation if dedupe is on
+prompt_cache_ttl = config_yaml.get("prompt_cache_ttl", 0)
+prompt_cache_size = config_yaml.get("prompt_cache_size", 1024)
+prompt_dedupe = config_yaml.get("prompt_dedupe", True)
+# webhook mode instead of long polling, e.g.
+# webhook: {enabled: true, host: 0.0.0.0, port: 8080, path: /webhook,
+#           secret_token: xxx, url: https://bot.example.com}
+# without url the webhook is not registered at telegram, updates can be posted
+# to http://host:port/path by hand to test locally. secret_token is required,
+# only a single worker which registers the webhook itself makes one up
+webhook = config_yaml.get("webhook") or {}
+webhook_enabled = bool(webhook.get("enabled", False))
+webhook_host = webhook.get("host", "127.0.0.1")
+webhook_port = webhook.get("port", 8080)
+webhook_path = webhook.get("path", "/webhook")
+webhook_secret = webhook.get("secret_token")
+webhook_url = webhook.get("url")
+# coordination of several bot workers sharing cookies, jobs and cron:
+# local (single process), sqlite ({backend: sqlite, path: db.sqlite}) or
+# redis ({backend: redis, url: redis://localhost:6379/0})
+coordination = config_yaml.get("coordination") or {}
+coordination_backend = coordination.get("backend", "local")
+# logging: {queue: true, json: false, queue_size: 10000}, queued records are
+# formatted and written on a background thread, dropped when the queue is full
+log = config_yaml.get("logging") or {}
+log_queue = bool(log.get("queue", True))
+log_json = bool(log.get("json", False))
+log_queue_size = log.get("queue_size", 10000)
+# prometheus text metrics on http://host:port/metrics, e.g.
+# metrics: {enabled: true, host: 127.0.0.1, port: 9100}
+metrics = config_yaml.get("metrics") or {}
+metrics_enabled = bool(metrics.get("enabled", False))
+metrics_host = metrics.get("host", "127.0.0.1")
+metrics_port = metrics.get("port", 9100)
+# diagnostic: measure event loop lag and log callbacks blocking it with stacks
+# loop_monitor: {enabled: true, interval: 0.1, threshold: 0.1}
+loop_monitor = config_yaml.get("loop_monitor") or {}
+loop_monitor_enabled = bool(loop_monitor.get("enabled", False))
+loop_monitor_interval = loop_monitor.get("interval", 0.1)
+loop_monitor_threshold = loop_monitor.get("threshold", 0.1)
+# credits are counted locally in the ledger and corrected with the upstream
+# numbers every credit_reconcile_minutes
+credit_reconcile_minutes = config_yaml.get("credit_reconcile_minutes", 30)
@@ -3,21 +3,37 @@
 # @Date     : 2024/3/25
 # @FileName : db.py
 # Created by; Andy963
+import hashlib
+import re
 from datetime import datetime, timedelta
 from functools import partial
 
 import pytz
 from sqlalchemy import Column, Integer, String, JSON, Boolean, func, Enum, \
-    ForeignKey
+    DDL, Float, ForeignKey, Index, case, event, insert, literal, select, text, update
 from sqlalchemy import create_engine, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, \
     joinedload
 
+from utils.metrics import db_query_seconds, instrument
+
 Base = declarative_base()
 
 TIMEZONE = "Asia/Shanghai"
 
 
+def set_sqlite_pragma(dbapi_connection, connection_record, busy_timeout=5000):
+    """WAL lets readers run next to the single writer, NORMAL sync is safe with WAL"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+    cursor.close()
+
+
 def get_cur_time(tz=TIMEZONE, delta_days=0):
     current_time = datetime.now(pytz.timezone(tz))
     if delta_days != 0:
@@ -25,17 +41,38 @@ def get_cur_time(tz=TIMEZONE, delta_days=0):
     return current_time
 
 
+def cookie_hash(content: str) -> str:
+    return hashlib.sha256(content.strip().encode()).hexdigest()
+
+
+def _content_hash_default(context):
+    return cookie_hash(context.get_current_parameters()["content"])
+
+
 class Cookie(Base):
     __tablename__ = "cookie"
     id = Column(Integer, primary_key=True)
     content = Column(String)
+    # sha256 of the stripped content, looked up instead of the long content
+    content_hash = Column(String, default=_content_hash_default)
     left_counts = Column(Integer, default=0)
     is_working = Column(Boolean, default=False)
+    is_valid = Column(Boolean, default=True)
     session_expired = Column(DateTime, default=partial(get_cur_time, delta_days=7))
     remark = Column(String, default="")
     created = Column(DateTime, default=get_cur_time)
     updated = Column(DateTime, default=get_cur_time, onupdate=get_cur_time)
 
+    __table_args__ = (
+        Index("ix_cookie_content_hash", "content_hash", unique=True),
+        # partial index over the cookies get_alive_cookie / get_left_count want
+        Index(
+            "ix_cookie_available",
+            "session_expired",
+            sqlite_where=text("left_counts > 0 AND is_working = 0 AND is_valid = 1"),
+        ),
+    )
+
 
 class Song(Base):
     __tablename__ = "song"
@@ -44,9 +81,47 @@ class Song(Base):
     lyric = Column(String)
     audio_url = Column(JSON, default=[])
     video_url = Column(JSON, default=[])
+    # normalized prompt and model, used to serve repeated prompts from cache
+    prompt = Column(String, nullable=True)
+    mv = Column(String, nullable=True)
+    # telegram file_id of each delivered clip, in audio_url order
+    file_ids = Column(JSON, default=[])
     created = Column(DateTime, default=get_cur_time)
     updated = Column(DateTime, default=get_cur_time, onupdate=get_cur_time)
 
+    __table_args__ = (Index("ix_song_prompt_mv_created", "prompt", "mv", "created"),)
+
+
+# FTS5 index over song names and lyrics. It is an external content table, the
+# text is only stored in song and the triggers keep the index in step with it;
+# alembic leaves song_fts* alone, see the song_fts migration.
+SONG_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS song_fts USING fts5(name, lyric, "
+    "content='song', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS song_fts_ai AFTER INSERT ON song BEGIN "
+    "INSERT INTO song_fts(rowid, name, lyric) VALUES (new.id, new.name, new.lyric); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS song_fts_ad AFTER DELETE ON song BEGIN "
+    "INSERT INTO song_fts(song_fts, rowid, name, lyric) "
+    "VALUES ('delete', old.id, old.name, old.lyric); END",
+    "CREATE TRIGGER IF NOT EXISTS song_fts_au AFTER UPDATE OF name, lyric ON song "
+    "BEGIN INSERT INTO song_fts(song_fts, rowid, name, lyric) "
+    "VALUES ('delete', old.id, old.name, old.lyric); "
+    "INSERT INTO song_fts(rowid, name, lyric) VALUES (new.id, new.name, new.lyric); "
+    "END",
+)
+for _statement in SONG_FTS_DDL:
+    event.listen(Song.__table__, "after_create", DDL(_statement))
+
+
+def song_match(terms: str, max_terms: int = 8):
+    """FTS5 match expression for free text, every word must appear and the last
+    one may be a prefix; None when there is no word to search for"""
+    words = re.findall(r"\w+", terms)[:max_terms]
+    if not words:
+        return None
+    return " ".join(f'"{w}"' for w in words) + "*"
+
 
 class Role(Base):
     __tablename__ = "roles"
@@ -76,9 +151,70 @@ class User(Base):
         return self.role.permissions >= Role.ADMIN
 
 
+class GenerationJob(Base):
+    __tablename__ = "generation_job"
+    id = Column(Integer, primary_key=True)
+    tg_id = Column(String)
+    chat_id = Column(Integer)
+    prompt = Column(String)
+    mv = Column(String, default="chirp-v3-0")
+    status = Column(String, default="queued", index=True)
+    cookie_id = Column(Integer, nullable=True)
+    clip_ids = Column(JSON, default=[])
+    song_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created = Column(DateTime, default=get_cur_time)
+    updated = Column(DateTime, default=get_cur_time, onupdate=get_cur_time)
+
+    QUEUED = "queued"
+    SUBMITTED = "submitted"
+    POLLING = "polling"
+    DELIVERING = "delivering"
+    DONE = "done"
+    FAILED = "failed"
+    FINISHED = (DONE, FAILED)
+
+
+class CreditLedger(Base):
+    """append-only log of every change to cookie.left_counts.
+
+    A generation reserves one credit before it is submitted, then the
+    reservation is consumed or refunded. Reconciliation with the credits
+    reported upstream is logged as one row with the correction in `amount`.
+    """
+
+    __tablename__ = "credit_ledger"
+    id = Column(Integer, primary_key=True)
+    cookie_id = Column(Integer, nullable=False)
+    job_id = Column(Integer, nullable=True)
+    kind = Column(String, nullable=False)
+    # change applied to left_counts and the balance after it
+    amount = Column(Integer, nullable=False, default=0)
+    balance = Column(Integer, nullable=True)
+    created = Column(DateTime, default=get_cur_time)
+
+    RESERVE = "reserve"
+    CONSUME = "consume"
+    REFUND = "refund"
+    RECONCILE = "reconcile"
+
+    __table_args__ = (Index("ix_credit_ledger_cookie_kind", "cookie_id", "kind"),)
+
+
+class Lease(Base):
+    """named lease held by one bot worker, see utils.coordination"""
+
+    __tablename__ = "lease"
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+
+@instrument(db_query_seconds, client="sync")
 class DB:
     def __init__(self, url="sqlite:///db.sqlite"):
         self.engine = create_engine(url=url, connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", set_sqlite_pragma)
         self.Session = sessionmaker(bind=self.engine)
 
     def get_all_cookie(self):
@@ -94,6 +230,17 @@ class DB:
             session.commit()
             return cookie
 
+    def bulk_update_cookies(self, rows: list):
+        """update many cookies in one transaction, rows are dicts with an `id` key"""
+        if not rows:
+            return
+        cur_time = get_cur_time()
+        with self.Session() as session:
+            session.bulk_update_mappings(
+                Cookie, [{**row, "updated": cur_time} for row in rows]
+            )
+            session.commit()
+
     def get_alive_cookie(self):
         """get a list of alive and idle cookie can be used to draw"""
         with self.Session() as session:
@@ -104,6 +251,7 @@ class DB:
                     Cookie.left_counts > 0,
                     Cookie.session_expired > cur_time,
                     Cookie.is_working == False,  # noqa: E712
+                    Cookie.is_valid == True,  # noqa: E712
                 )
                 .first()
             )
@@ -115,7 +263,6 @@ class DB:
                 content=content,
                 is_working=False,
                 left_counts=left_counts,
-                is_expired=False,
             )
             session.add(cookie)
             session.commit()
@@ -123,7 +270,11 @@ class DB:
 
     def get_cookie_by_content(self, content: str):
         with self.Session() as session:
-            cookie = session.query(Cookie).filter(Cookie.content == content).first()
+            cookie = (
+                session.query(Cookie)
+                .filter(Cookie.content_hash == cookie_hash(content))
+                .first()
+            )
             return cookie
 
     def update_cookie(
@@ -152,6 +303,7 @@ class DB:
                     Cookie.session_expired > cur_time,
                     Cookie.left_counts > 0,
                     Cookie.is_working == False,  # noqa: E712
+                    Cookie.is_valid == True,  # noqa: E712
                 )
                 .scalar()
             )
@@ -179,8 +331,404 @@ class DB:
             return user
 
 
+@instrument(db_query_seconds, client="async")
+class AsyncDB:
+    """asyncio version of DB on aiosqlite, the methods mirror DB.
+
+    Connections are pooled and every one of them runs in WAL mode, so reads
+    from concurrent handlers do not wait for each other or for a writer.
+    """
+
+    def __init__(
+        self,
+        url="sqlite+aiosqlite:///db.sqlite",
+        pool_size: int = 5,
+        max_overflow: int = 10,
+    ):
+        # aiosqlite defaults to NullPool, which opens a connection per session
+        self.engine = create_async_engine(
+            url=url,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+        )
+        event.listen(self.engine.sync_engine, "connect", set_sqlite_pragma)
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def get_all_cookie(self):
+        async with self.Session() as session:
+            result = await session.execute(select(Cookie))
+            return result.scalars().all()
+
+    async def update_session_expired(self, cookie_id, dt):
+        async with self.Session() as session:
+            cookie = await session.get(Cookie, cookie_id)
+            cookie.session_expired = dt
+            cookie.updated = get_cur_time()
+            await session.commit()
+            return cookie
+
+    async def bulk_update_cookies(self, rows: list):
+        """update many cookies in one transaction, rows are dicts with an `id` key"""
+        if not rows:
+            return
+        cur_time = get_cur_time()
+        async with self.Session() as session:
+            await session.execute(
+                update(Cookie), [{**row, "updated": cur_time} for row in rows]
+            )
+            await session.commit()
+
+    async def get_alive_cookie(self):
+        """get a list of alive and idle cookie can be used to draw"""
+        async with self.Session() as session:
+            cur_time = datetime.now(pytz.timezone(TIMEZONE))
+            result = await session.execute(
+                select(Cookie)
+                .filter(
+                    Cookie.left_counts > 0,
+                    Cookie.session_expired > cur_time,
+                    Cookie.is_working == False,  # noqa: E712
+                    Cookie.is_valid == True,  # noqa: E712
+                )
+                .limit(1)
+            )
+            return result.scalars().first()
+
+    async def create_cookie(self, content: str, left_counts: int = 5):
+        async with self.Session() as session:
+            cookie = Cookie(
+                content=content,
+                is_working=False,
+                left_counts=left_counts,
+            )
+            session.add(cookie)
+            await session.commit()
+            return cookie
+
+    async def get_cookie_by_content(self, content: str):
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Cookie)
+                .filter(Cookie.content_hash == cookie_hash(content))
+                .limit(1)
+            )
+            return result.scalars().first()
+
+    async def get_cookie_hashes(self, hashes: list) -> set:
+        """the given content hashes which are stored already"""
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Cookie.content_hash).filter(Cookie.content_hash.in_(hashes))
+            )
+            return set(result.scalars().all())
+
+    async def bulk_create_cookies(self, rows: list, chunk_size: int = 500) -> dict:
+        """insert many cookies in one transaction, rows are dicts of Cookie
+        columns with `content`. A content stored already is skipped; returns
+        {content hash: new cookie id} of the inserted rows."""
+        if not rows:
+            return {}
+        cur_time = get_cur_time()
+        values = [
+            {
+                "left_counts": 0,
+                "is_working": False,
+                "is_valid": True,
+                "session_expired": get_cur_time(delta_days=7),
+                **row,
+                "content": row["content"].strip(),
+                "content_hash": cookie_hash(row["content"]),
+                "created": cur_time,
+                "updated": cur_time,
+            }
+            for row in rows
+        ]
+        inserted = {}
+        async with self.Session() as session:
+            # chunks keep each statement below sqlite's bound parameter limit
+            for i in range(0, len(values), chunk_size):
+                result = await session.execute(
+                    sqlite_insert(Cookie)
+                    .values(values[i: i + chunk_size])
+                    .on_conflict_do_nothing(index_elements=["content_hash"])
+                    .returning(Cookie.content_hash, Cookie.id)
+                )
+                inserted.update(result.all())
+            await session.commit()
+        return inserted
+
+    async def update_cookie(
+        self,
+        cookie_id: int,
+        left_counts: int,
+        session_expired: datetime = None,
+        is_working: bool = False,
+    ):
+        async with self.Session() as session:
+            cookie = await session.get(Cookie, cookie_id)
+            cookie.left_counts = left_counts
+            if session_expired:
+                cookie.session_expired = session_expired
+            cookie.is_working = is_working
+            cookie.updated = get_cur_time()
+            await session.commit()
+            return cookie
+
+    async def get_left_count(self):
+        async with self.Session() as session:
+            cur_time = datetime.now(pytz.timezone(TIMEZONE))
+            total_left_counts = await session.scalar(
+                select(func.sum(Cookie.left_counts)).filter(
+                    Cookie.session_expired > cur_time,
+                    Cookie.left_counts > 0,
+                    Cookie.is_working == False,  # noqa: E712
+                    Cookie.is_valid == True,  # noqa: E712
+                )
+            )
+            return total_left_counts if total_left_counts else 0
+
+    async def _change_credits(
+        self, session, cookie_id: int, job_id, kind: str, amount: int
+    ):
+        """apply amount to left_counts in one statement and log it, the balance
+        after the change is returned, None when it would drop below zero"""
+        result = await session.execute(
+            update(Cookie)
+            .where(Cookie.id == cookie_id, Cookie.left_counts + amount >= 0)
+            .values(left_counts=Cookie.left_counts + amount, updated=get_cur_time())
+            .returning(Cookie.left_counts)
+        )
+        balance = result.scalar()
+        if balance is not None:
+            session.add(
+                CreditLedger(
+                    cookie_id=cookie_id,
+                    job_id=job_id,
+                    kind=kind,
+                    amount=amount,
+                    balance=balance,
+                )
+            )
+        return balance
+
+    async def reserve_credit(self, cookie_id: int, job_id: int = None):
+        """take one credit of the cookie, None if it has none left"""
+        async with self.Session() as session:
+            balance = await self._change_credits(
+                session, cookie_id, job_id, CreditLedger.RESERVE, -1
+            )
+            await session.commit()
+            return balance
+
+    async def refund_credit(self, cookie_id: int, job_id: int = None):
+        """give back a reserved credit which was not spent upstream"""
+        async with self.Session() as session:
+            balance = await self._change_credits(
+                session, cookie_id, job_id, CreditLedger.REFUND, 1
+            )
+            await session.commit()
+            return balance
+
+    async def consume_credit(self, cookie_id: int, job_id: int = None):
+        """mark a reservation as spent upstream, left_counts is not touched"""
+        async with self.Session() as session:
+            session.add(
+                CreditLedger(
+                    cookie_id=cookie_id, job_id=job_id, kind=CreditLedger.CONSUME
+                )
+            )
+            await session.commit()
+
+    async def reconcile_credits(self, upstream: dict, window: float = 3600) -> dict:
+        """set left_counts to the credits reported upstream ({cookie id: credits})
+        minus the reservations still in flight, in one transaction.
+
+        Reservations older than `window` seconds count as settled, so one lost
+        by a crash does not hold a credit forever. Returns {cookie id: new
+        left_counts} for the cookies whose count was off.
+        """
+        cur_time = get_cur_time()
+        in_flight = func.coalesce(
+            select(
+                func.sum(
+                    case(
+                        (CreditLedger.kind == CreditLedger.RESERVE, 1),
+                        (
+                            CreditLedger.kind.in_(
+                                (CreditLedger.CONSUME, CreditLedger.REFUND)
+                            ),
+                            -1,
+                        ),
+                        else_=0,
+                    )
+                )
+            )
+            .where(
+                CreditLedger.cookie_id == Cookie.id,
+                CreditLedger.created >= cur_time - timedelta(seconds=window),
+            )
+            .scalar_subquery(),
+            0,
+        )
+        pending = func.max(in_flight, 0)
+        drift = {}
+        async with self.Session() as session:
+            for cookie_id, credits in upstream.items():
+                target = literal(credits) - pending
+                # the insert takes the write lock, left_counts can not change
+                # between the ledger row and the update
+                await session.execute(
+                    insert(CreditLedger).from_select(
+                        ["cookie_id", "kind", "amount", "balance", "created"],
+                        select(
+                            Cookie.id,
+                            literal(CreditLedger.RECONCILE),
+                            target - Cookie.left_counts,
+                            target,
+                            literal(cur_time),
+                        ).where(Cookie.id == cookie_id, Cookie.left_counts != target),
+                    )
+                )
+                result = await session.execute(
+                    update(Cookie)
+                    .where(Cookie.id == cookie_id, Cookie.left_counts != target)
+                    .values(left_counts=target, updated=cur_time)
+                    .returning(Cookie.left_counts)
+                )
+                if (balance := result.scalar()) is not None:
+                    drift[cookie_id] = balance
+            await session.commit()
+        return drift
+
+    async def create_song(
+        self,
+        name: str,
+        lyric: str,
+        audio_url: list,
+        video_url: list = None,
+        prompt: str = None,
+        mv: str = None,
+    ):
+        async with self.Session() as session:
+            song = Song(
+                name=name,
+                lyric=lyric,
+                audio_url=audio_url,
+                video_url=video_url,
+                prompt=prompt,
+                mv=mv,
+            )
+            session.add(song)
+            await session.commit()
+            return song
+
+    async def get_song(self, song_id: int):
+        async with self.Session() as session:
+            return await session.get(Song, song_id)
+
+    async def update_song_file_ids(self, song_id: int, file_ids: list):
+        async with self.Session() as session:
+            await session.execute(
+                update(Song)
+                .where(Song.id == song_id)
+                .values(file_ids=file_ids, updated=get_cur_time())
+            )
+            await session.commit()
+
+    async def search_songs(self, terms: str, limit: int = 10, offset: int = 0):
+        """(total, [(id, name, lyric snippet)]) of the songs matching `terms`,
+        best first; a hit in the name weighs ten times one in the lyric"""
+        match = song_match(terms)
+        if match is None:
+            return 0, []
+        async with self.Session() as session:
+            total = await session.scalar(
+                text("SELECT count(*) FROM song_fts WHERE song_fts MATCH :match"),
+                {"match": match},
+            )
+            if not total:
+                return 0, []
+            result = await session.execute(
+                text(
+                    "SELECT song.id, song.name, "
+                    "snippet(song_fts, 1, '', '', '...', 10) FROM song_fts "
+                    "JOIN song ON song.id = song_fts.rowid "
+                    "WHERE song_fts MATCH :match "
+                    "ORDER BY bm25(song_fts, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+                ),
+                {"match": match, "limit": limit, "offset": offset},
+            )
+            return total, [tuple(row) for row in result]
+
+    async def find_song(self, prompt: str, mv: str, since: datetime):
+        """the latest song generated for a normalized prompt since `since`"""
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Song)
+                .filter(Song.prompt == prompt, Song.mv == mv, Song.created >= since)
+                .order_by(Song.created.desc())
+                .limit(1)
+            )
+            return result.scalars().first()
+
+    async def get_user(self, tg_id: str):
+        async with self.Session() as session:
+            result = await session.execute(
+                select(User)
+                .options(joinedload(User.role))
+                .filter(User.tg_id == tg_id)
+                .limit(1)
+            )
+            return result.scalars().first()
+
+    async def get_cookie(self, cookie_id: int):
+        async with self.Session() as session:
+            return await session.get(Cookie, cookie_id)
+
+    async def create_job(self, tg_id: str, chat_id: int, prompt: str, **kwargs):
+        async with self.Session() as session:
+            job = GenerationJob(
+                tg_id=str(tg_id), chat_id=chat_id, prompt=prompt, **kwargs
+            )
+            session.add(job)
+            await session.commit()
+            return job
+
+    async def update_job(self, job_id: int, **fields):
+        async with self.Session() as session:
+            await session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job_id)
+                .values(updated=get_cur_time(), **fields)
+            )
+            await session.commit()
+
+    async def get_jobs(self, job_ids: list):
+        async with self.Session() as session:
+            result = await session.execute(
+                select(GenerationJob).filter(GenerationJob.id.in_(job_ids))
+            )
+            return result.scalars().all()
+
+    async def get_unfinished_jobs(self):
+        """jobs interrupted by a restart, oldest first"""
+        async with self.Session() as session:
+            result = await session.execute(
+                select(GenerationJob)
+                .filter(GenerationJob.status.not_in(GenerationJob.FINISHED))
+                .order_by(GenerationJob.id)
+            )
+            return result.scalars().all()
+
+
 db = DB()
+adb = AsyncDB()
 __all__ = [
     "db",
+    "adb",
     "Base",
 ]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/25
+# @FileName : cookie_import.py
+# Created by; Andy963
+import asyncio
+import json
+import time
+
+import config
+from db import adb, cookie_hash
+from utils.cookie_pool import cookie_pool
+from utils.logger import FileSplitLogger
+from utils.suno import AsyncSongsGen
+from utils.tasks import probe_health
+
+import_logger = FileSplitLogger("./logs/tasks.log").logger
+
+ADDED = "added"
+DUPLICATE = "duplicate"
+INVALID = "invalid"
+
+
+class ImportResult:
+    __slots__ = ("index", "content", "status", "cookie_id", "value", "error")
+
+    def __init__(self, index: int, content: str):
+        self.index = index
+        self.content = content
+        self.status = None
+        self.cookie_id = None
+        self.value = None  # probe_health result of a valid cookie
+        self.error = None
+
+    def __str__(self):
+        if self.status == ADDED:
+            expired = self.value["session_expired"]
+            expired = expired.strftime("%Y-%m-%d") if expired else "unknown"
+            return (
+                f"#{self.index} added as {self.cookie_id}, "
+                f"{self.value['left_counts']} left, expires {expired}"
+            )
+        if self.status == INVALID:
+            return f"#{self.index} invalid: {self.error}"[:200]
+        return f"#{self.index} {self.status}"
+
+
+def parse_cookies(text: str) -> list:
+    """one cookie per line; a line may also be a json string or an object with
+    a `cookie` or `content` key (.jsonl), blank and # lines are skipped"""
+    contents = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line[0] in "{\"":
+            try:
+                item = json.loads(line)
+            except ValueError:
+                pass
+            else:
+                if isinstance(item, dict):
+                    item = item.get("cookie") or item.get("content") or ""
+                line = str(item).strip()
+        contents.append(line)
+    return contents
+
+
+async def _probe(content: str) -> dict:
+    # not `async with`: __aexit__ is skipped when the login in __aenter__
+    # fails or wait_for cancels it, and the session would leak
+    sg = AsyncSongsGen(content)
+    try:
+        await sg.login()
+        return await probe_health(sg)
+    finally:
+        await sg.close()
+
+
+async def _validate(content: str, semaphore: asyncio.Semaphore, timeout: float):
+    async with semaphore:
+        return await asyncio.wait_for(_probe(content), timeout)
+
+
+async def import_cookies(contents: list) -> list:
+    """Validate new cookies against clerk and billing concurrently and store
+    the valid ones in one transaction.
+
+    Cookies already stored, or repeated in `contents`, are reported as
+    duplicates and never sent upstream. Returns one ImportResult per content.
+    """
+    started = time.monotonic()
+    results = [ImportResult(i, c) for i, c in enumerate(contents, 1)]
+    stored = await adb.get_cookie_hashes([cookie_hash(c) for c in contents])
+    seen = set()
+    todo = []
+    for r in results:
+        key = cookie_hash(r.content)
+        if len(r.content) < 10:
+            r.status, r.error = INVALID, "too short"
+        elif key in stored or key in seen:
+            r.status = DUPLICATE
+        else:
+            todo.append(r)
+        seen.add(key)
+
+    semaphore = asyncio.Semaphore(config.task_concurrency)
+    timeout = config.task_timeout
+    values = await asyncio.gather(
+        *[_validate(r.content, semaphore, timeout) for r in todo],
+        return_exceptions=True,
+    )
+    rows = []
+    for r, value in zip(todo, values):
+        if isinstance(value, Exception):
+            r.status, r.error = INVALID, repr(value)
+            continue
+        r.value = value
+        row = {"content": r.content, "left_counts": value["left_counts"]}
+        if value["session_expired"] is not None:
+            row["session_expired"] = value["session_expired"]
+        rows.append(row)
+
+    inserted = await adb.bulk_create_cookies(rows)
+    for r in todo:
+        if r.status is not None:
+            continue
+        r.cookie_id = inserted.get(cookie_hash(r.content))
+        # stored by another import in the meantime
+        r.status = ADDED if r.cookie_id is not None else DUPLICATE
+    if inserted:
+        await cookie_pool.refresh(force=True)
+    import_logger.info(
+        f"cookie import: {summary(results)}, took {time.monotonic() - started:.1f}s"
+    )
+    return results
+
+
+def summary(results: list) -> str:
+    counts = {ADDED: 0, DUPLICATE: 0, INVALID: 0}
+    for r in results:
+        counts[r.status] += 1
+    return f"{len(results)} cookies, " + ", ".join(
+        f"{n} {status}" for status, n in counts.items()
+    )
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/9
+# @FileName : cookie_pool.py
+# Created by; Andy963
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytz
+
+import config
+from db import adb, TIMEZONE
+from utils.coordination import coordinator, worker_id
+from utils.logger import FileSplitLogger
+from utils.ratelimit import breaker
+
+pool_logger = FileSplitLogger("./logs/bot.log").logger
+
+
+class CookieState:
+    __slots__ = (
+        "id",
+        "content",
+        "left_counts",
+        "session_expired",
+        "is_valid",
+        "in_use",
+        "reserved",
+        "last_used",
+    )
+
+    def __init__(self, cookie):
+        self.id = cookie.id
+        self.in_use = 0
+        self.reserved = 0  # leases whose credit left_counts already lacks
+        self.last_used = 0.0
+        self.sync(cookie)
+
+    def sync(self, cookie):
+        self.content = cookie.content
+        self.left_counts = cookie.left_counts or 0
+        self.session_expired = cookie.session_expired
+        self.is_valid = cookie.is_valid is not False
+
+    @property
+    def available_counts(self) -> int:
+        return self.left_counts - (self.in_use - self.reserved)
+
+
+class CookieLease:
+    __slots__ = (
+        "cookie_id", "content", "deadline", "released", "reserved", "slot",
+        "owner"
+    )
+
+    def __init__(self, state: CookieState, deadline: float):
+        self.cookie_id = state.id
+        self.content = state.content
+        self.deadline = deadline
+        self.released = False
+        self.reserved = False
+        # the coordinator lease held when several workers share the cookies
+        self.slot = None
+        self.owner = f"{worker_id}#{uuid.uuid4().hex[:8]}"
+
+
+class CookiePool:
+    """In-memory scheduler over the `cookie` table.
+
+    `acquire` picks and leases a cookie without awaiting in between, so two
+    coroutines never get the same slot. Cookies with the most credits left are
+    preferred, then the least recently used one, then the one whose session
+    expires first. Each cookie serves at most `max_concurrency` leases at a
+    time; a lease not released within `lease_timeout` seconds is reclaimed.
+    Cookies quarantined by the circuit breaker are skipped until it closes.
+    When several bot workers share the cookies, each lease also holds one of
+    the cookie's `cookie:<id>:<slot>` coordinator leases.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        lease_timeout: float = 900,
+        refresh_interval: float = 60,
+    ):
+        self.max_concurrency = max_concurrency
+        self.lease_timeout = lease_timeout
+        self.refresh_interval = refresh_interval
+        self._states = {}  # cookie id -> CookieState
+        self._leases = set()
+        self._refreshed = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, force: bool = False):
+        async with self._lock:
+            if not force and time.monotonic() - self._refreshed < self.refresh_interval:
+                return
+            cookies = await adb.get_all_cookie()
+            alive = set()
+            for ck in cookies:
+                alive.add(ck.id)
+                if ck.id in self._states:
+                    self._states[ck.id].sync(ck)
+                else:
+                    self._states[ck.id] = CookieState(ck)
+            for cookie_id in set(self._states) - alive:
+                self._states.pop(cookie_id)
+            self._refreshed = time.monotonic()
+
+    async def _reclaim_expired(self):
+        now = time.monotonic()
+        for lease in [i for i in self._leases if i.deadline < now]:
+            pool_logger.warning(f"Cookie: {lease.cookie_id} lease timeout, reclaimed")
+            await self.release(lease)
+
+    def _candidates(self, exclude=()) -> list:
+        cur_time = datetime.now(pytz.timezone(TIMEZONE)).replace(tzinfo=None)
+        candidates = [
+            s
+            for s in self._states.values()
+            if s.is_valid
+            and s.id not in exclude
+            and not breaker.is_open(s.id)
+            and s.available_counts > 0
+            and s.in_use < self.max_concurrency
+            and (s.session_expired is None or s.session_expired > cur_time)
+        ]
+        return sorted(
+            candidates,
+            key=lambda s: (
+                -s.available_counts,
+                s.last_used,
+                s.session_expired or datetime.max,
+            ),
+        )
+
+    def _lease(self, state: CookieState) -> CookieLease:
+        state.in_use += 1
+        state.last_used = time.monotonic()
+        lease = CookieLease(state, time.monotonic() + self.lease_timeout)
+        self._leases.add(lease)
+        return lease
+
+    async def _take_slot(self, lease: CookieLease) -> bool:
+        """hold one of the cookie's max_concurrency slots across all workers"""
+        for slot in range(self.max_concurrency):
+            name = f"cookie:{lease.cookie_id}:{slot}"
+            if await coordinator.try_lease(name, self.lease_timeout, lease.owner):
+                lease.slot = name
+                return True
+        return False
+
+    async def acquire(
+        self, cookie_id: int = None, exclude=()
+    ) -> [CookieLease, None]:
+        """lease the best available cookie, None if every cookie is busy or empty.
+
+        With `cookie_id` only that cookie is leased, whatever its credits, this
+        is used to resume work which already runs on an account; it still
+        waits for one of the cookie's slots. Cookies in `exclude`, e.g. the
+        ones a job already failed on, are not considered.
+        """
+        await self.refresh()
+        await self._reclaim_expired()
+        if cookie_id is not None:
+            state = self._states.get(cookie_id)
+            if state is None or state.in_use >= self.max_concurrency:
+                return None
+            candidates = [state]
+        else:
+            candidates = self._candidates(exclude)
+        for state in candidates:
+            # reserved locally before awaiting the coordinator
+            lease = self._lease(state)
+            if not coordinator.shared or await self._take_slot(lease):
+                return lease
+            await self.release(lease)
+        return None
+
+    def __contains__(self, cookie_id: int) -> bool:
+        return cookie_id in self._states
+
+    def capacity(self) -> int:
+        """how many generations the usable cookies can run at the same time"""
+        cur_time = datetime.now(pytz.timezone(TIMEZONE)).replace(tzinfo=None)
+        return sum(
+            min(s.left_counts, self.max_concurrency)
+            for s in self._states.values()
+            if s.is_valid
+            and s.left_counts > 0
+            and (s.session_expired is None or s.session_expired > cur_time)
+        )
+
+    def has_credits(self, exclude=()) -> bool:
+        """whether any usable cookie has credits left, busy or quarantined"""
+        cur_time = datetime.now(pytz.timezone(TIMEZONE)).replace(tzinfo=None)
+        return any(
+            s.is_valid
+            and s.id not in exclude
+            and s.left_counts > 0
+            and (s.session_expired is None or s.session_expired > cur_time)
+            for s in self._states.values()
+        )
+
+    async def release(self, lease: CookieLease):
+        if lease.released:
+            return
+        lease.released = True
+        self._leases.discard(lease)
+        state = self._states.get(lease.cookie_id)
+        if state is not None:
+            state.in_use = max(state.in_use - 1, 0)
+            if lease.reserved:
+                state.reserved = max(state.reserved - 1, 0)
+        if lease.slot is not None:
+            await coordinator.release(lease.slot, lease.owner)
+
+    def update_counts(self, cookie_id: int, left_counts: int):
+        """record the credits reported upstream for a cookie"""
+        state = self._states.get(cookie_id)
+        if state is not None:
+            state.left_counts = left_counts
+
+    def reserve(self, lease: CookieLease, left_counts: int = None):
+        """the lease's credit was reserved, `left_counts` no longer includes it"""
+        state = self._states.get(lease.cookie_id)
+        if state is None or lease.released:
+            return
+        if left_counts is not None:
+            state.left_counts = left_counts
+        if not lease.reserved:
+            lease.reserved = True
+            state.reserved += 1
+
+    def refund(self, lease: CookieLease, left_counts: int = None):
+        """the lease's reserved credit was given back"""
+        state = self._states.get(lease.cookie_id)
+        if state is None or not lease.reserved:
+            return
+        lease.reserved = False
+        state.reserved = max(state.reserved - 1, 0)
+        if left_counts is not None:
+            state.left_counts = left_counts
+
+    @asynccontextmanager
+    async def lease(self):
+        """async with cookie_pool.lease() as lease: ..., lease is None if exhausted"""
+        lease = await self.acquire()
+        try:
+            yield lease
+        finally:
+            if lease is not None:
+                await self.release(lease)
+
+
+cookie_pool = CookiePool(max_concurrency=config.cookie_concurrency)
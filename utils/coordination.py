@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/20
+# @FileName : coordination.py
+# Created by; Andy963
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+import os
+import socket
+import time
+import uuid
+
+import aiosqlite
+
+import config
+from utils.logger import FileSplitLogger
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis is only needed for the redis backend
+    aioredis = None
+
+coord_logger = FileSplitLogger("./logs/bot.log").logger
+
+# identifies this process in every lease it holds
+worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Coordinator(ABC):
+    """Named leases with an owner and a ttl, shared by every bot worker.
+
+    A lease is granted when it is free, expired or already held by the same
+    owner (which renews it). `shared` tells whether other processes can see
+    the leases, a single process does not need to poll for foreign work.
+    """
+
+    shared = True
+
+    @abstractmethod
+    async def try_lease(self, name: str, ttl: float, owner: str = worker_id) -> bool:
+        pass
+
+    @abstractmethod
+    async def release(self, name: str, owner: str = worker_id):
+        pass
+
+    @abstractmethod
+    async def unleased(self, names: list) -> list:
+        """the names nobody holds a live lease on, a read which locks nothing"""
+
+    async def close(self):
+        pass
+
+
+class LocalCoordinator(Coordinator):
+    """in process leases, the default for a single bot process"""
+
+    shared = False
+
+    def __init__(self):
+        self._leases = {}  # name -> (owner, expires_at)
+
+    async def try_lease(self, name: str, ttl: float, owner: str = worker_id) -> bool:
+        now = time.time()
+        holder = self._leases.get(name)
+        if holder is None or holder[0] == owner or holder[1] < now:
+            self._leases[name] = (owner, now + ttl)
+            return True
+        return False
+
+    async def release(self, name: str, owner: str = worker_id):
+        holder = self._leases.get(name)
+        if holder is not None and holder[0] == owner:
+            self._leases.pop(name)
+
+    async def unleased(self, names: list) -> list:
+        now = time.time()
+        return [
+            n for n in names if n not in self._leases or self._leases[n][1] < now
+        ]
+
+
+class SQLiteCoordinator(Coordinator):
+    """leases in the `lease` table of the bot's sqlite file.
+
+    Every change runs in a BEGIN IMMEDIATE transaction, which takes the write
+    lock up front, so the read-check-write of a lease can not interleave with
+    another process.
+    """
+
+    def __init__(self, path: str = "db.sqlite", busy_timeout: float = 5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._conn = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            self._conn = await aiosqlite.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None
+            )
+        return self._conn
+
+    async def try_lease(self, name: str, ttl: float, owner: str = worker_id) -> bool:
+        async with self._lock:
+            conn = await self._connect()
+            now = time.time()
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = await conn.execute(
+                    "SELECT owner, expires_at FROM lease WHERE name = ?", (name,)
+                )
+                holder = await cursor.fetchone()
+                granted = holder is None or holder[0] == owner or holder[1] < now
+                if granted:
+                    await conn.execute(
+                        "INSERT OR REPLACE INTO lease (name, owner, expires_at) "
+                        "VALUES (?, ?, ?)",
+                        (name, owner, now + ttl),
+                    )
+                await conn.execute("COMMIT")
+                return granted
+            except Exception:
+                await conn.execute("ROLLBACK")
+                raise
+
+    async def release(self, name: str, owner: str = worker_id):
+        async with self._lock:
+            conn = await self._connect()
+            await conn.execute(
+                "DELETE FROM lease WHERE name = ? AND owner = ?", (name, owner)
+            )
+
+    async def unleased(self, names: list) -> list:
+        held = set()
+        async with self._lock:
+            conn = await self._connect()
+            # sqlite takes at most 999 variables per statement before 3.32
+            for i in range(0, len(names), 900):
+                chunk = names[i: i + 900]
+                cursor = await conn.execute(
+                    f"SELECT name FROM lease WHERE expires_at >= ? AND name IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    (time.time(), *chunk),
+                )
+                held.update(row[0] for row in await cursor.fetchall())
+        return [n for n in names if n not in held]
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+class RedisCoordinator(Coordinator):
+    """leases as redis keys with a PX expiry, for workers on several hosts"""
+
+    _acquire_script = """
+    local holder = redis.call('GET', KEYS[1])
+    if holder == false or holder == ARGV[1] then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    _release_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "suno:"):
+        if aioredis is None:
+            raise RuntimeError("the redis backend needs `pip install redis`")
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url)
+        self._acquire = self._redis.register_script(self._acquire_script)
+        self._release = self._redis.register_script(self._release_script)
+
+    async def try_lease(self, name: str, ttl: float, owner: str = worker_id) -> bool:
+        granted = await self._acquire(
+            keys=[self.prefix + name], args=[owner, int(ttl * 1000)]
+        )
+        return bool(granted)
+
+    async def release(self, name: str, owner: str = worker_id):
+        await self._release(keys=[self.prefix + name], args=[owner])
+
+    async def unleased(self, names: list) -> list:
+        if not names:
+            return []
+        # expired leases are gone, redis drops the keys after their PX
+        holders = await self._redis.mget([self.prefix + n for n in names])
+        return [n for n, holder in zip(names, holders) if holder is None]
+
+    async def close(self):
+        await self._redis.close()
+
+
+class LeaderElector:
+    """keep trying to hold the `name` lease, only the holder runs cron jobs"""
+
+    def __init__(self, coord: Coordinator, name: str = "leader", ttl: float = 30):
+        self.coord = coord
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self.coord.release(self.name)
+
+    async def _run(self):
+        while True:
+            try:
+                leader = await self.coord.try_lease(self.name, self.ttl)
+            except Exception as e:
+                coord_logger.warning(f"leader election failed: {e}")
+                leader = False
+            if leader != self.is_leader:
+                coord_logger.info(f"{worker_id} leader: {leader}")
+            self.is_leader = leader
+            await asyncio.sleep(self.ttl / 3)
+
+    def wrap(self, func):
+        """run the coroutine function only while this process is the leader"""
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if self.is_leader:
+                return await func(*args, **kwargs)
+            coord_logger.info(f"{func.__name__} skipped, {worker_id} is no leader")
+
+        return wrapper
+
+
+def create_coordinator(backend: str) -> Coordinator:
+    if backend == "sqlite":
+        return SQLiteCoordinator(config.coordination.get("path", "db.sqlite"))
+    if backend == "redis":
+        return RedisCoordinator(config.coordination.get("url"))
+    return LocalCoordinator()
+
+
+coordinator = create_coordinator(config.coordination_backend)
+leader = LeaderElector(coordinator)
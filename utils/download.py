@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/13
+# @FileName : download.py
+# Created by; Andy963
+import asyncio
+
+import aiohttp
+
+from utils.logger import FileSplitLogger
+from utils.metrics import retries_total
+from utils.transport import PoolStats
+
+download_logger = FileSplitLogger("./logs/bot.log").logger
+
+cdn_url = "https://cdn1.suno.ai"
+
+_http_session = None
+cdn_stats = PoolStats("cdn")
+
+
+class ClipDownloadError(Exception):
+    pass
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    """count the requests which had to open a new connection in cdn_stats"""
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.new_connection = True
+
+    async def on_request_end(session, ctx, params):
+        cdn_stats.record(params.url.host, getattr(ctx, "new_connection", False))
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """process wide aiohttp session, keeps the cdn connections alive"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=300, sock_read=60),
+            trace_configs=[_trace_config()],
+        )
+    return _http_session
+
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+async def _fetch(
+    url: str, content_type: str, min_size: int, max_size: int, chunk_size: int
+) -> bytes:
+    async with get_http_session().get(url, allow_redirects=False) as response:
+        if response.status != 200:
+            raise ClipDownloadError(f"{url} responded {response.status}")
+        if not response.content_type.startswith(content_type):
+            raise ClipDownloadError(f"{url} is {response.content_type}")
+        if response.content_length and response.content_length > max_size:
+            raise ClipDownloadError(f"{url} is too large: {response.content_length}")
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            data.extend(chunk)
+            if len(data) > max_size:
+                raise ClipDownloadError(f"{url} is larger than {max_size} bytes")
+    if len(data) < min_size:
+        raise ClipDownloadError(f"{url} is too small: {len(data)} bytes")
+    return bytes(data)
+
+
+async def download_clip(
+    url: str,
+    content_type: str = "audio/",
+    min_size: int = 1024,
+    max_size: int = 50 * 1024 * 1024,
+    chunk_size: int = 256 * 1024,
+    max_retries: int = 5,
+) -> bytes:
+    """download a clip into memory, the cdn may lag behind the feed status so
+    failed attempts are retried with a growing delay"""
+    retry_count = 0
+    while True:
+        try:
+            return await _fetch(url, content_type, min_size, max_size, chunk_size)
+        except (ClipDownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retry_count += 1
+            retries_total.inc(kind="download")
+            if retry_count >= max_retries:
+                raise ClipDownloadError(f"download {url} failed: {e}") from e
+            download_logger.warning(
+                f"Could not download {url}: {e}, retry attempt {retry_count}"
+            )
+            await asyncio.sleep(5 * retry_count)
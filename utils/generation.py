@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/15
+# @FileName : generation.py
+# Created by; Andy963
+import asyncio
+import time
+from collections import OrderedDict, deque
+from functools import partial
+
+from aiogram import Bot, enums
+from aiogram.types import BufferedInputFile
+
+import config
+from db import adb, get_cur_time, GenerationJob
+from utils.cookie_pool import cookie_pool
+from utils.coordination import coordinator
+from utils.download import cdn_url, download_clip
+from utils.logger import FileSplitLogger, log_context
+from utils.metrics import (
+    cookie_failures, credits_consumed, jobs_total, retries_total, stage_seconds
+)
+from utils.prompt_cache import prompt_cache, prompt_key
+from utils.readiness import clip_tracker, clip_title_lyric
+from utils.session_cache import client_cache
+from utils.suno import is_auth_failure
+
+job_logger = FileSplitLogger("./logs/bot.log").logger
+
+
+class FairQueue:
+    """asyncio queue which hands out items round robin over their owners,
+    one user flooding the queue does not delay the others"""
+
+    def __init__(self):
+        self._users = OrderedDict()  # user -> deque of items
+        self._size = 0
+        self._cond = asyncio.Condition()
+
+    def __len__(self):
+        return self._size
+
+    async def put(self, user, item, front: bool = False):
+        async with self._cond:
+            items = self._users.setdefault(user, deque())
+            if front:
+                items.appendleft(item)
+            else:
+                items.append(item)
+            self._size += 1
+            self._cond.notify()
+
+    async def get(self):
+        async with self._cond:
+            while not self._users:
+                try:
+                    await self._cond.wait()
+                except asyncio.CancelledError:
+                    # a notify this waiter consumed goes to the next one
+                    if self._users:
+                        self._cond.notify()
+                    raise
+            user, items = next(iter(self._users.items()))
+            item = items.popleft()
+            self._users.pop(user)
+            if items:
+                # the user goes to the back of the line
+                self._users[user] = items
+            self._size -= 1
+            return item
+
+
+async def gather_all(*aws) -> list:
+    """asyncio.gather which cancels, and waits for, the other awaitables once
+    one fails, so nothing keeps running after the caller cleaned up"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def send_clip(
+    bot: Bot, chat_ids: list, url: str, filename: str, caption: str, file_id=None
+) -> str:
+    """send one clip to the chats and return its telegram file_id.
+
+    The clip is downloaded and uploaded once at most, the other chats (and any
+    later delivery given `file_id`) reuse the file already on telegram.
+    """
+    for chat_id in chat_ids:
+        await bot.send_chat_action(chat_id, enums.ChatAction.UPLOAD_VOICE)
+        if file_id is None:
+            with stage_seconds.time(stage="download"):
+                data = await download_clip(url)
+            af = BufferedInputFile(data, filename=filename)
+            with stage_seconds.time(stage="upload"):
+                msg = await bot.send_audio(chat_id, audio=af, caption=caption)
+            file_id = msg.audio.file_id
+        else:
+            with stage_seconds.time(stage="resend"):
+                await bot.send_audio(chat_id, audio=file_id, caption=caption)
+    return file_id
+
+
+async def send_song(bot: Bot, song, chat_ids: list):
+    """deliver a stored song, by file_id where it was delivered before"""
+    file_ids = list(song.file_ids or [])
+    file_ids += [None] * (len(song.audio_url) - len(file_ids))
+    sent = await gather_all(
+        *[
+            send_clip(
+                bot,
+                chat_ids,
+                url,
+                f"{song.name.replace(' ', '_')}_{index}.mp3",
+                song.lyric,
+                file_ids[index - 1],
+            )
+            for index, url in enumerate(song.audio_url, 1)
+        ]
+    )
+    if sent != file_ids:
+        await adb.update_song_file_ids(song.id, sent)
+
+
+class NoCookieError(Exception):
+    pass
+
+
+class FailoverError(Exception):
+    """the job failed on its cookie before spending credits, try another one"""
+
+
+class GenerationQueue:
+    """Persistent /sing job queue consumed by a pool of async workers.
+
+    A job moves through queued -> submitted -> polling -> delivering -> done,
+    or failed; every step is written to the `generation_job` table so jobs left
+    unfinished by a restart are picked up again on start. Clips of a resumed
+    job may be sent twice, but credits are never spent twice once the clip ids
+    are stored.
+
+    Jobs with the same normalized prompt and model form a group: only the first
+    one is queued and generates, the others get its result delivered to their
+    chats as well; a job joining once delivery started gets the whole song
+    afterwards. A song stored recently for the prompt is served from the
+    prompt cache without generating at all, by telegram file_id when possible.
+
+    A job failing before its clips exist, e.g. on a quarantined or rate
+    limited account, is queued again for another cookie, up to `failover`
+    times. Once clips exist they can only be polled on their own account.
+
+    Each job is held through a `job:<id>` coordinator lease renewed by a
+    heartbeat. With a shared coordinator several bot workers poll the table
+    and claim queued jobs, or jobs whose worker died, while they have free
+    capacity.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        cookie_wait: float = 5,
+        dedupe: bool = True,
+        job_ttl: float = 60,
+        poll_interval: float = 2,
+        failover: int = 2,
+    ):
+        self.workers = workers
+        self.base_workers = workers
+        self.cookie_wait = cookie_wait
+        self.dedupe = dedupe
+        self.job_ttl = job_ttl
+        self.poll_interval = poll_interval
+        self.failover = failover
+        self.bot = None
+        self._queue = FairQueue()
+        self._groups = {}  # prompt key -> [leader job, *followers]
+        self._owned = set()  # ids of the jobs this worker holds a lease on
+        self._lost = set()  # ids of owned jobs whose lease another worker took
+        self._running = {}  # job id -> task running the job
+        self._sent_to = {}  # job id -> chats its delivery started for
+        self._tried = {}  # job id -> ids of the cookies the job failed on
+        self._scales = []  # worker counts asked for by running batches
+        self._workers = []
+        self._idle = set()  # workers waiting for a job
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        await self._claim_jobs()
+        self._resize()
+        if coordinator.shared:
+            self._tasks.append(asyncio.create_task(self._feed()))
+            self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    def scale(self, workers: int):
+        """run at least `workers` workers, e.g. one per cookie slot for a batch,
+        until the same count is handed back with `unscale`"""
+        self._scales.append(workers)
+        self._resize()
+
+    def unscale(self, workers: int):
+        if workers in self._scales:
+            self._scales.remove(workers)
+        self._resize()
+
+    def _resize(self):
+        self.workers = max([self.base_workers, *self._scales])
+        if self.bot is None:
+            return
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._worker()))
+        # idle workers go at once, busy ones once their job is done
+        for task in list(self._idle)[: len(self._workers) - self.workers]:
+            self._idle.discard(task)
+            self._workers.remove(task)
+            task.cancel()
+
+    async def stop(self):
+        tasks = self._tasks + self._workers
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._workers = []
+
+    async def submit(self, tg_id, chat_id: int, prompt: str) -> GenerationJob:
+        job = await adb.create_job(tg_id, chat_id, prompt)
+        # a busy worker leaves the job in the table for an idle one to claim,
+        # a single worker has nobody to leave it to
+        busy = coordinator.shared and len(self._queue) >= self.workers
+        if not busy and await self._lease(job):
+            await self._enqueue(job)
+        return job
+
+    async def _lease(self, job: GenerationJob) -> bool:
+        if await coordinator.try_lease(f"job:{job.id}", self.job_ttl):
+            self._owned.add(job.id)
+            return True
+        return False
+
+    async def _release(self, jobs: list):
+        for job in jobs:
+            self._owned.discard(job.id)
+            self._lost.discard(job.id)
+            await coordinator.release(f"job:{job.id}")
+
+    async def _claim_jobs(self):
+        """take over queued jobs and jobs of workers which stopped renewing"""
+        jobs = [j for j in await adb.get_unfinished_jobs() if j.id not in self._owned]
+        # only jobs without a live lease are worth the write lock of try_lease
+        free = set(await coordinator.unleased([f"job:{j.id}" for j in jobs]))
+        for job in jobs:
+            if len(self._queue) >= self.workers and coordinator.shared:
+                break
+            if f"job:{job.id}" not in free or not await self._lease(job):
+                continue
+            job_logger.info(f"Job: {job.id} claimed with status {job.status}")
+            await self._enqueue(job)
+
+    async def _feed(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._claim_jobs()
+            except Exception as e:
+                job_logger.warning(f"claim jobs failed with: {e}")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.job_ttl / 3)
+            for job_id in list(self._owned):
+                try:
+                    renewed = await coordinator.try_lease(f"job:{job_id}", self.job_ttl)
+                except Exception as e:
+                    job_logger.warning(f"Job: {job_id} renew lease failed: {e}")
+                    continue
+                if renewed or job_id not in self._owned:
+                    continue
+                # another worker claimed the job, stop running it here
+                job_logger.warning(f"Job: {job_id} lease lost, aborting")
+                self._owned.discard(job_id)
+                self._lost.add(job_id)
+                run = self._running.get(job_id)
+                if run is not None:
+                    run.cancel()
+
+    async def _enqueue(self, job: GenerationJob):
+        key = prompt_key(job.prompt, job.mv)
+        if self.dedupe and key in self._groups and not job.clip_ids:
+            job_logger.info(f"Job: {job.id} joined job {self._groups[key][0].id}")
+            self._groups[key].append(job)
+            return
+        if self.dedupe:
+            self._groups.setdefault(key, [job])
+        await self._queue.put(job.tg_id, job)
+
+    def _pop_group(self, job: GenerationJob) -> list:
+        key = prompt_key(job.prompt, job.mv)
+        group = self._groups.get(key)
+        if group and group[0] is job:
+            return self._groups.pop(key)
+        return [job]
+
+    def _group_chats(self, job: GenerationJob) -> list:
+        group = self._groups.get(prompt_key(job.prompt, job.mv))
+        if not group or group[0] is not job:
+            group = [job]
+        return list(dict.fromkeys(j.chat_id for j in group))
+
+    async def _worker(self):
+        worker = asyncio.current_task()
+        while True:
+            if len(self._workers) > self.workers:
+                self._workers.remove(worker)
+                return
+            self._idle.add(worker)
+            try:
+                job = await self._queue.get()
+            finally:
+                self._idle.discard(worker)
+            if job.id in self._lost:
+                await self._abandon(job)
+                continue
+            with log_context(job_id=job.id, tg_id=job.tg_id):
+                run = asyncio.create_task(self._run(job))
+            self._running[job.id] = run
+            run.add_done_callback(partial(self._running.pop, job.id))
+            try:
+                await run
+            except asyncio.CancelledError:
+                if job.id not in self._lost:
+                    raise
+                await self._abandon(job)
+                continue
+            except NoCookieError:
+                # every cookie is busy, try again once one is released
+                await self._queue.put(job.tg_id, job, front=True)
+                await asyncio.sleep(self.cookie_wait)
+                continue
+            except FailoverError:
+                await self._queue.put(job.tg_id, job, front=True)
+                continue
+            except Exception as e:
+                job_logger.error(f"Job: {job.id} get songs failed with: {e}")
+                group = self._pop_group(job)
+                self._tried.pop(job.id, None)
+                self._sent_to.pop(job.id, None)
+                for j in group:
+                    await self._fail(j, e)
+                jobs_total.inc(len(group), status=GenerationJob.FAILED)
+                await self._release(group)
+                continue
+            group = self._pop_group(job)
+            self._tried.pop(job.id, None)
+            late = await self._deliver_late(job, group[1:])
+            for j in group[1:]:
+                if j in late:
+                    continue
+                await adb.update_job(
+                    j.id, status=GenerationJob.DONE, song_id=job.song_id
+                )
+            jobs_total.inc(len(group) - 1 - len(late), status="joined")
+            await self._release(group)
+
+    async def _deliver_late(self, job: GenerationJob, followers: list) -> list:
+        """send the song to followers which joined after its delivery started,
+        return the ones it could not be sent to"""
+        sent_to = self._sent_to.pop(job.id, ())
+        late = [j for j in followers if j.chat_id not in sent_to]
+        if not late:
+            return []
+        try:
+            song = await adb.get_song(job.song_id)
+            chats = list(dict.fromkeys(j.chat_id for j in late))
+            await send_song(self.bot, song, chats)
+        except Exception as e:
+            job_logger.error(f"Job: {job.id} late delivery failed with: {e}")
+            for j in late:
+                await self._fail(j, e)
+            jobs_total.inc(len(late), status=GenerationJob.FAILED)
+            return late
+        return []
+
+    async def _abandon(self, job: GenerationJob):
+        """drop a job whose lease was lost, its followers are left for others"""
+        group = self._pop_group(job)
+        self._tried.pop(job.id, None)
+        self._sent_to.pop(job.id, None)
+        self._lost.discard(job.id)
+        await self._release(group[1:])
+
+    async def _fail(self, job: GenerationJob, error: Exception):
+        try:
+            await adb.update_job(job.id, status=GenerationJob.FAILED, error=str(error))
+            await self.bot.send_message(
+                job.chat_id, "get songs failed please check the log"
+            )
+        except Exception as e:
+            job_logger.error(f"Job: {job.id} report failure failed with: {e}")
+
+    async def _run(self, job: GenerationJob):
+        if not job.clip_ids:
+            song = await prompt_cache.get(prompt_key(job.prompt, job.mv))
+            if song is not None:
+                job_logger.info(f"Job: {job.id} served from song {song.id}")
+                # time from /sing until a worker starts on the job
+                stage_seconds.observe(self._age(job), stage="queue")
+                await self._deliver_song(job, song)
+                jobs_total.inc(status="cached")
+                return
+        tried = self._tried.setdefault(job.id, set())
+        ck = await cookie_pool.acquire(job.cookie_id, exclude=tried)
+        if not ck:
+            if job.cookie_id is None and cookie_pool.has_credits(exclude=tried):
+                raise NoCookieError()
+            if job.cookie_id is not None and job.cookie_id in cookie_pool:
+                # the job's account is busy, resume once a slot is released
+                raise NoCookieError()
+            raise Exception("Idle cookie is not available")
+        if job.clip_ids:
+            # the credit was taken when the job was submitted
+            cookie_pool.reserve(ck)
+        stage_seconds.observe(self._age(job), stage="queue")
+        sg = None
+        try:
+            sg = await client_cache.acquire(ck.cookie_id, ck.content)
+            if not job.clip_ids:
+                with stage_seconds.time(stage="submit"):
+                    await self._submit(job, ck, sg)
+            with stage_seconds.time(stage="deliver"):
+                await self._deliver(job, sg)
+            await adb.update_job(job.id, status=GenerationJob.DONE)
+            jobs_total.inc(status=GenerationJob.DONE)
+            stage_seconds.observe(self._age(job), stage="total")
+        except asyncio.CancelledError:
+            if sg is not None and job.clip_ids:
+                clip_tracker.discard(sg, job.clip_ids)
+            raise
+        except Exception as e:
+            if sg is not None and job.clip_ids:
+                clip_tracker.discard(sg, job.clip_ids)
+            if not job.clip_ids and len(tried) < self.failover:
+                tried.add(ck.cookie_id)
+                retries_total.inc(kind="failover")
+                job_logger.warning(
+                    f"Job: {job.id} failed on cookie {ck.cookie_id}, "
+                    f"failing over: {e}"
+                )
+                raise FailoverError() from e
+            raise
+        finally:
+            if sg is not None:
+                await client_cache.release(sg)
+            await cookie_pool.release(ck)
+
+    @staticmethod
+    def _age(job: GenerationJob) -> float:
+        # created is aware on a new job, naive once loaded back from sqlite
+        created = job.created.replace(tzinfo=None)
+        return (get_cur_time().replace(tzinfo=None) - created).total_seconds()
+
+    @staticmethod
+    async def _submit(job: GenerationJob, ck, sg):
+        # the credit is reserved in the ledger, upstream credits are reconciled
+        # on a schedule instead of being fetched for every generation
+        left_count = await adb.reserve_credit(ck.cookie_id, job.id)
+        if left_count is None:
+            cookie_failures.inc(reason="no_credits")
+            cookie_pool.update_counts(ck.cookie_id, 0)
+            raise Exception(f"Cookie: {ck.cookie_id} is is running out of usage.")
+        cookie_pool.reserve(ck, left_count)
+        try:
+            job.clip_ids = await sg.generate(prompt=job.prompt, mv=job.mv)
+        except Exception as e:
+            cookie_failures.inc(reason="generate")
+            # a 429 or 5xx says nothing about the session, keep the client
+            if is_auth_failure(e):
+                await client_cache.invalidate(ck.cookie_id)
+            left_count = await adb.refund_credit(ck.cookie_id, job.id)
+            cookie_pool.refund(ck, left_count)
+            raise
+        await adb.consume_credit(ck.cookie_id, job.id)
+        credits_consumed.inc(cookie=ck.cookie_id)
+        job.cookie_id = ck.cookie_id
+        await adb.update_job(
+            job.id,
+            status=GenerationJob.SUBMITTED,
+            cookie_id=job.cookie_id,
+            clip_ids=job.clip_ids,
+        )
+
+    async def _deliver_song(self, job: GenerationJob, song):
+        job.song_id = song.id
+        await adb.update_job(job.id, status=GenerationJob.DELIVERING, song_id=song.id)
+        chats = self._group_chats(job)
+        self._sent_to[job.id] = chats
+        await send_song(self.bot, song, chats)
+        await adb.update_job(job.id, status=GenerationJob.DONE)
+
+    async def _deliver(self, job: GenerationJob, sg):
+        audio_urls = [f"{cdn_url}/{i}.mp3" for i in job.clip_ids]
+        video_urls = [f"{cdn_url}/{i}.mp4" for i in job.clip_ids]
+        song_saved = job.song_id is not None
+        if not song_saved:
+            await adb.update_job(job.id, status=GenerationJob.POLLING)
+        # every clip goes to the same chats, later joiners get the whole song
+        chats = self._group_chats(job)
+        self._sent_to[job.id] = chats
+
+        async def deliver(index: int, clip_future: asyncio.Future):
+            nonlocal song_saved
+            clip = await clip_future
+            stage_seconds.observe(time.perf_counter() - start, stage="poll")
+            song_name, lyric = clip_title_lyric(clip)
+            if not song_saved:
+                song_saved = True
+                key = prompt_key(job.prompt, job.mv)
+                song = await adb.create_song(
+                    name=song_name,
+                    lyric=lyric,
+                    audio_url=audio_urls,
+                    video_url=video_urls,
+                    prompt=key[0],
+                    mv=key[1],
+                )
+                prompt_cache.put(key, song.id)
+                job.song_id = song.id
+                await adb.update_job(
+                    job.id, status=GenerationJob.DELIVERING, song_id=song.id
+                )
+            file_ids[index - 1] = await send_clip(
+                self.bot,
+                chats,
+                f"{cdn_url}/{clip['id']}.mp3",
+                f"{song_name.replace(' ', '_')}_{index}.mp3",
+                lyric,
+            )
+
+        file_ids = [None] * len(job.clip_ids)
+        start = time.perf_counter()
+        try:
+            # every clip is downloaded and sent as soon as it is ready on suno
+            await gather_all(
+                *[
+                    deliver(index, clip_future)
+                    for index, clip_future in enumerate(
+                        clip_tracker.track(sg, job.clip_ids), 1
+                    )
+                ]
+            )
+        finally:
+            if job.song_id is not None and any(file_ids):
+                await adb.update_song_file_ids(job.song_id, file_ids)
+
+
+generation_queue = GenerationQueue(
+    workers=config.generation_workers,
+    dedupe=config.prompt_dedupe,
+    failover=config.generation_failover,
+)
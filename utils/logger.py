@@ -4,23 +4,100 @@
 # @FileName : logger.py # noqa
 # Created by; Andy963
 
+import atexit
+import contextvars
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict
 
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
 
-class SingletonMeta(type):
-    _instances = {}
+import config
 
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super().__call__(*args, **kwargs)
-        return cls._instances[cls]
+# ids of the update or job being handled, attached to every record
+_log_context = contextvars.ContextVar("log_context", default={})
 
 
-class FileSplitLogger(metaclass=SingletonMeta):
+@contextmanager
+def log_context(**fields):
+    """add fields like update_id or job_id to the records logged inside"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """bind the telegram update id, chat and user to the handler's log records"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        fields = {}
+        if data.get("event_update") is not None:
+            fields["update_id"] = data["event_update"].update_id
+        if data.get("event_chat") is not None:
+            fields["chat_id"] = data["event_chat"].id
+        if data.get("event_from_user") is not None:
+            fields["tg_id"] = data["event_from_user"].id
+        with log_context(**fields):
+            return await handler(event, data)
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per line, with the log context fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "path": f"{record.pathname}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        line.update(getattr(record, "context", None) or {})
+        if record.exc_info:
+            line["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler over a bounded queue which drops records when it is full.
+
+    Only the log context is captured on the calling thread, formatting and file
+    I/O (rotation included) happen on the listener thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.context = _log_context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class FileSplitLogger:
     _loggers = {}
+    _queue_handlers = {}
+    _listeners = []
 
     def __init__(
         self,
@@ -45,8 +122,12 @@ class FileSplitLogger(metaclass=SingletonMeta):
         log_dir = Path(filename).parent
         log_dir.mkdir(parents=True, exist_ok=True)
 
-        format_str = logging.Formatter(fmt)
+        if config.log_json:
+            format_str = JsonFormatter()
+        else:
+            format_str = logging.Formatter(fmt)
 
+        handlers = []
         file_handler = RotatingFileHandler(
             filename=filename,
             maxBytes=max_bytes,
@@ -54,15 +135,40 @@ class FileSplitLogger(metaclass=SingletonMeta):
             encoding=encoding,
         )
         file_handler.setFormatter(format_str)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
         if os.getenv("DEBUG_MODE", "").lower() == "true":
             console_handler = logging.StreamHandler()
             console_handler.setFormatter(format_str)
-            logger.addHandler(console_handler)
-
+            handlers.append(console_handler)
+
+        if not config.log_queue:
+            for handler in handlers:
+                logger.addHandler(handler)
+            return logger
+
+        queue_handler = DroppingQueueHandler(queue.Queue(config.log_queue_size))
+        listener = QueueListener(queue_handler.queue, *handlers)
+        listener.start()
+        logger.addHandler(queue_handler)
+        self._queue_handlers[logger.name] = queue_handler
+        self._listeners.append(listener)
         return logger
 
+    @classmethod
+    def stats(cls) -> dict:
+        """queued and dropped records of each queued logger"""
+        return {
+            name: {"queued": h.queue.qsize(), "dropped": h.dropped}
+            for name, h in cls._queue_handlers.items()
+        }
+
+    @classmethod
+    def stop(cls):
+        """write out the queued records and stop the listener threads"""
+        while cls._listeners:
+            cls._listeners.pop().stop()
+
     def debug(self, msg, *args, **kwargs):
         self.logger.debug(msg, *args, **kwargs)
 
@@ -79,8 +185,12 @@ class FileSplitLogger(metaclass=SingletonMeta):
         self.logger.critical(msg, *args, **kwargs)
 
 
+atexit.register(FileSplitLogger.stop)
+
+
 if __name__ == "__main__":
     logger1 = FileSplitLogger("./logs/test.log", level=logging.DEBUG)
     logger2 = FileSplitLogger("./logs/test.log", level=logging.INFO)
     logger1.debug("This is a debug message")
-    logger2.info("This is an info message")
+    with log_context(job_id=1):
+        logger2.info("This is an info message")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/23
+# @FileName : loop_monitor.py
+# Created by; Andy963
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+import config
+from utils.logger import FileSplitLogger
+from utils.metrics import registry
+
+monitor_logger = FileSplitLogger("./logs/bot.log").logger
+
+loop_lag_seconds = registry.histogram(
+    "event_loop_lag_seconds",
+    "delay of the event loop waking up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+loop_blocked = registry.counter(
+    "event_loop_blocked_total", "callbacks which blocked the loop over the threshold"
+)
+
+
+class LoopMonitor:
+    """Measure event loop lag and catch the callbacks which block the loop.
+
+    A task sleeps `interval` seconds in a loop and records how late it wakes
+    up. A watchdog thread checks that task's heartbeat; once the loop has not
+    come back for `threshold` seconds it grabs the loop thread's stack, which
+    then points into the blocking call. When the loop recovers the stall is
+    logged with that stack and kept in the last `keep` samples for /stats.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, keep: int = 10):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=keep)
+        self._beat = time.monotonic()
+        self._stack = None  # (beat, stack, innermost frame) from the watchdog
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-monitor", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            beat = self._beat
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - beat - self.interval, 0)
+            self._beat = now
+            loop_lag_seconds.observe(lag)
+            if lag >= self.threshold:
+                self._blocked(beat, lag)
+
+    def _blocked(self, beat: float, lag: float):
+        stack, where = "", "?"
+        if self._stack and self._stack[0] == beat:
+            _, stack, where = self._stack
+        loop_blocked.inc()
+        self.samples.append(
+            {
+                "at": datetime.now().strftime("%H:%M:%S"),
+                "lag": lag,
+                "where": where,
+                "stack": stack,
+            }
+        )
+        monitor_logger.warning(
+            f"event loop blocked for {lag:.3f}s\n{stack or '(no stack captured)'}"
+        )
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._beat
+            late = time.monotonic() - beat - self.interval
+            if late < self.threshold or (self._stack and self._stack[0] == beat):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            frames = traceback.extract_stack(frame)
+            where = f"{frames[-1].filename}:{frames[-1].lineno} {frames[-1].name}"
+            self._stack = (beat, "".join(traceback.format_list(frames)), where)
+
+    def stats(self) -> dict:
+        count, total, p95 = loop_lag_seconds.summary().get((), (0, 0, 0))
+        return {
+            "lag_avg_ms": round(total / count * 1000, 1) if count else 0,
+            "lag_p95_s": p95,
+            "blocked": int(loop_blocked.value()),
+            "last_blocked": [
+                f"{i['at']} {i['lag']:.3f}s {i['where']}" for i in self.samples
+            ][-3:],
+        }
+
+
+loop_monitor = LoopMonitor(
+    interval=config.loop_monitor_interval, threshold=config.loop_monitor_threshold
+)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/21
+# @FileName : metrics.py
+# Created by; Andy963
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# seconds, from a cached db read up to a slow generation
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+)
+
+
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + pairs + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self._values = {}  # sorted label items -> value
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+
+class Histogram:
+    """cumulative buckets plus sum and count per label set, like prometheus"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, doc: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        item = self._values.get(key)
+        if item is None:
+            item = self._values[key] = [0] * (len(self.buckets) + 2)
+        item[bisect_left(self.buckets, value)] += 1
+        item[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self) -> dict:
+        """labels -> (count, sum, approximate p95 upper bound)"""
+        result = {}
+        for labels, item in self._values.items():
+            count = sum(item[:-1])
+            target, seen, p95 = count * 0.95, 0, float("inf")
+            for bound, n in zip(self.buckets, item):
+                seen += n
+                if seen >= target:
+                    p95 = bound
+                    break
+            result[labels] = (count, item[-1], p95)
+        return result
+
+    def samples(self):
+        for labels, item in self._values.items():
+            seen = 0
+            for bound, n in zip(self.buckets + ("+Inf",), item):
+                seen += n
+                yield f"{self.name}_bucket", labels + (("le", bound),), seen
+            yield f"{self.name}_sum", labels, item[-1]
+            yield f"{self.name}_count", labels, seen
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, cls, name: str, doc: str, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, doc, **kwargs)
+        return metric
+
+    def counter(self, name: str, doc: str) -> Counter:
+        return self._get(Counter, name, doc)
+
+    def histogram(self, name: str, doc: str, **kwargs) -> Histogram:
+        return self._get(Histogram, name, doc, **kwargs)
+
+    def render(self) -> str:
+        """the text exposition format scraped by prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_label_str(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+suno_request_seconds = registry.histogram(
+    "suno_request_seconds", "suno / clerk api calls by method"
+)
+suno_request_errors = registry.counter(
+    "suno_request_errors_total", "suno / clerk api calls which raised"
+)
+db_query_seconds = registry.histogram(
+    "db_query_seconds", "db methods by name"
+)
+stage_seconds = registry.histogram(
+    "generation_stage_seconds", "/sing pipeline stages"
+)
+jobs_total = registry.counter("generation_jobs_total", "finished /sing jobs by status")
+credits_consumed = registry.counter(
+    "suno_credits_consumed_total", "generations submitted, by cookie"
+)
+cookie_failures = registry.counter(
+    "cookie_failures_total", "cookies which failed, by reason"
+)
+retries_total = registry.counter("retries_total", "retried operations, by kind")
+
+
+def timed(histogram: Histogram, errors: Counter = None, **labels):
+    """decorator observing the duration of a sync or async function"""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(histogram: Histogram, errors: Counter = None, **labels):
+    """class decorator timing every public method, labelled by method name.
+
+    Private helpers run inside a public method, timing them too would count
+    their time twice.
+    """
+
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(func):
+                continue
+            setattr(cls, name, timed(histogram, errors, method=name, **labels)(func))
+        return cls
+
+    return decorator
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain")
+
+
+class MetricsServer:
+    """local aiohttp server exposing GET /metrics"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def _fmt_labels(labels: tuple) -> str:
+    return ",".join(str(v) for _, v in labels) or "-"
+
+
+def stats_text(extra: dict = None) -> str:
+    """short human summary of the metrics for the /stats command"""
+    lines = ["Jobs: " + (
+        ", ".join(
+            f"{_fmt_labels(labels)} {int(v)}" for _, labels, v in jobs_total.samples()
+        ) or "none"
+    )]
+    lines.append(f"Credits used: {int(sum(v for *_, v in credits_consumed.samples()))}")
+    failures = ", ".join(
+        f"{_fmt_labels(labels)} {int(v)}" for _, labels, v in cookie_failures.samples()
+    )
+    lines.append(f"Cookie failures: {failures or 'none'}")
+    retries = ", ".join(
+        f"{_fmt_labels(labels)} {int(v)}" for _, labels, v in retries_total.samples()
+    )
+    lines.append(f"Retries: {retries or 'none'}")
+    for title, histogram in (
+        ("Stages", stage_seconds),
+        ("Suno calls", suno_request_seconds),
+    ):
+        lines.append(f"{title} (count / avg / p95 s):")
+        for labels, (count, total, p95) in sorted(histogram.summary().items()):
+            lines.append(
+                f"  {_fmt_labels(labels)}: {count} / {total / count:.2f} / {p95}"
+            )
+    slow = sorted(
+        db_query_seconds.summary().items(), key=lambda i: i[1][1], reverse=True
+    )[:5]
+    lines.append("DB time (count / total s):")
+    for labels, (count, total, _) in slow:
+        lines.append(f"  {_fmt_labels(labels)}: {count} / {total:.2f}")
+    for name, value in (extra or {}).items():
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/12
+# @FileName : permission.py
+# Created by; Andy963
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+from sqlalchemy import event
+
+from db import adb, Role, User
+
+
+class PermissionCache:
+    """TTL + LRU cache of the role permissions of telegram users.
+
+    Unknown users are cached as well (permissions None) so spam from strangers
+    does not hit the db either. Entries are dropped when a User or Role row is
+    changed through the ORM, and expire after `ttl` seconds in any case.
+    """
+
+    def __init__(self, ttl: float = 300, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # tg_id -> (expire_at, permissions)
+
+    async def get_permissions(self, tg_id) -> [int, None]:
+        tg_id = str(tg_id)
+        item = self._data.get(tg_id)
+        if item is not None and item[0] > time.monotonic():
+            self._data.move_to_end(tg_id)
+            self.hits += 1
+            return item[1]
+        self.misses += 1
+        user = await adb.get_user(tg_id)
+        permissions = user.role.permissions if user and user.role else None
+        self._data[tg_id] = (time.monotonic() + self.ttl, permissions)
+        self._data.move_to_end(tg_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return permissions
+
+    async def is_admin(self, tg_id) -> bool:
+        permissions = await self.get_permissions(tg_id)
+        return permissions is not None and permissions >= Role.ADMIN
+
+    def invalidate(self, tg_id=None):
+        """drop one user, or everything when tg_id is None"""
+        if tg_id is None:
+            self._data.clear()
+        else:
+            self._data.pop(str(tg_id), None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+perm_cache = PermissionCache()
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target):
+    perm_cache.invalidate(target.tg_id)
+
+
+@event.listens_for(Role, "after_insert")
+@event.listens_for(Role, "after_update")
+@event.listens_for(Role, "after_delete")
+def _role_changed(mapper, connection, target):
+    perm_cache.invalidate()
+
+
+class PermissionMiddleware(BaseMiddleware):
+    """reject handlers flagged with `flags={"admin": True}` for non admin users"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if get_flag(data, "admin") and not await perm_cache.is_admin(
+            event.from_user.id
+        ):
+            await event.answer("You do not have permission to use this command")
+            return
+        return await handler(event, data)
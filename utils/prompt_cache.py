@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/17
+# @FileName : prompt_cache.py
+# Created by; Andy963
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import config
+from db import adb, get_cur_time
+
+
+def normalize_prompt(prompt: str) -> str:
+    """prompts differing in case or whitespace only produce the same key"""
+    return " ".join(prompt.lower().split())
+
+
+def prompt_key(prompt: str, mv: str) -> tuple:
+    return normalize_prompt(prompt), mv
+
+
+class PromptCache:
+    """Map (normalized prompt, mv) to the id of a song stored recently.
+
+    Keys live in an LRU of at most `maxsize` entries and are served for `ttl`
+    seconds after the song was created; on a miss the `song` table is searched
+    so the cache survives restarts. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: float = 0, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expire_at, song id)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def get(self, key: tuple):
+        """the cached Song for key, None on a miss"""
+        if not self.enabled:
+            return None
+        item = self._data.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._data.move_to_end(key)
+            song = await adb.get_song(item[1])
+        else:
+            self._data.pop(key, None)
+            prompt, mv = key
+            since = get_cur_time() - timedelta(seconds=self.ttl)
+            song = await adb.find_song(prompt, mv, since=since)
+            if song is not None:
+                self.put(key, song.id, created=song.created)
+        if song is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return song
+
+    def put(self, key: tuple, song_id: int, created=None):
+        if not self.enabled:
+            return
+        ttl = self.ttl
+        if created is not None:
+            age = (get_cur_time().replace(tzinfo=None) - created).total_seconds()
+            ttl = max(ttl - age, 0)
+        self._data[key] = (time.monotonic() + ttl, song_id)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+prompt_cache = PromptCache(
+    ttl=config.prompt_cache_ttl, maxsize=config.prompt_cache_size
+)
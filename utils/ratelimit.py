@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/29
+# @FileName : ratelimit.py
+# Created by; Andy963
+import asyncio
+import time
+
+import config
+from utils.logger import FileSplitLogger
+from utils.metrics import registry
+
+ratelimit_logger = FileSplitLogger("./logs/suno.log").logger
+
+ratelimit_wait = registry.counter(
+    "suno_ratelimit_wait_seconds_total", "time spent waiting for a token, by endpoint"
+)
+circuit_opened = registry.counter(
+    "cookie_circuit_opened_total", "cookies quarantined by their breaker, by status"
+)
+
+# statuses which say the account or the endpoint is in trouble
+FAILURE_STATUSES = {401, 403, 429}
+
+
+class UpstreamError(Exception):
+    def __init__(self, endpoint: str, status: int, text: str = ""):
+        super().__init__(f"{endpoint} responded {status}: {text[:200]}")
+        self.endpoint = endpoint
+        self.status = status
+
+
+def is_failure(status: int) -> bool:
+    return status in FAILURE_STATUSES or status >= 500
+
+
+class TokenBucket:
+    """`rate` requests per second with bursts of up to `burst`, 0 is unlimited.
+
+    Waiters take the lock in turn, so they are served first come first served.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _fill(self):
+        now = time.monotonic()
+        refill = (now - self._updated) * self.rate
+        self._tokens = min(self.burst, self._tokens + refill)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        """take a token, return the seconds waited for it"""
+        if not self.rate:
+            return 0
+        async with self._lock:
+            self._fill()
+            wait = 0
+            if self._tokens < 1:
+                wait = (1 - self._tokens) / self.rate
+                await asyncio.sleep(wait)
+                self._fill()
+            self._tokens -= 1
+            return wait
+
+
+class RateLimiter:
+    """one token bucket per upstream endpoint, shared by every cookie"""
+
+    def __init__(self, limits: dict):
+        # endpoint -> requests per second, or (rate, burst)
+        self._buckets = {}
+        for endpoint, limit in limits.items():
+            rate, burst = limit if isinstance(limit, (list, tuple)) else (limit, None)
+            self._buckets[endpoint] = TokenBucket(rate, burst)
+
+    async def acquire(self, endpoint: str):
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return
+        wait = await bucket.acquire()
+        if wait:
+            ratelimit_wait.inc(wait, endpoint=endpoint)
+
+
+class _Circuit:
+    __slots__ = ("failures", "opened_until", "cooldown", "status")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_until = 0.0
+        self.cooldown = 0.0
+        self.status = None
+
+
+class CircuitBreaker:
+    """Quarantine cookies whose requests keep failing.
+
+    `threshold` failed responses in a row (401/403/429/5xx) open the cookie's
+    circuit for `cooldown` seconds, during which the cookie pool skips it.
+    Afterwards one request is let through: a success closes the circuit, a
+    failure opens it again for twice as long, up to `max_cooldown`.
+    """
+
+    def __init__(
+        self, threshold: int = 3, cooldown: float = 60, max_cooldown: float = 1800
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._circuits = {}  # cookie id -> _Circuit
+
+    def is_open(self, cookie_id: int) -> bool:
+        circuit = self._circuits.get(cookie_id)
+        return circuit is not None and circuit.opened_until > time.monotonic()
+
+    def success(self, cookie_id: int):
+        if cookie_id is not None:
+            self._circuits.pop(cookie_id, None)
+
+    def failure(self, cookie_id: int, status: int):
+        if cookie_id is None:
+            return
+        circuit = self._circuits.setdefault(cookie_id, _Circuit())
+        circuit.failures += 1
+        circuit.status = status
+        # a cookie on trial after its cooldown is opened again at once
+        if circuit.failures < self.threshold and not circuit.cooldown:
+            return
+        if circuit.opened_until > time.monotonic():
+            return
+        circuit.cooldown = min(circuit.cooldown * 2 or self.cooldown, self.max_cooldown)
+        circuit.opened_until = time.monotonic() + circuit.cooldown
+        circuit_opened.inc(status=status)
+        ratelimit_logger.warning(
+            f"Cookie: {cookie_id} quarantined for {circuit.cooldown:.0f}s "
+            f"after {circuit.failures} failures, last status {status}"
+        )
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            cookie_id: f"{c.status} for {c.opened_until - now:.0f}s"
+            for cookie_id, c in self._circuits.items()
+            if c.opened_until > now
+        }
+
+
+rate_limiter = RateLimiter(config.rate_limits)
+breaker = CircuitBreaker(
+    threshold=config.breaker_threshold, cooldown=config.breaker_cooldown
+)
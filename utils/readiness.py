@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/8
+# @FileName : readiness.py
+# Created by; Andy963
+import asyncio
+import random
+import re
+import time
+
+from utils.logger import FileSplitLogger
+from utils.metrics import retries_total
+
+readiness_logger = FileSplitLogger("./logs/suno.log").logger
+
+CLIP_COMPLETE = "complete"
+CLIP_ERROR = "error"
+
+
+def clip_title_lyric(clip: dict) -> tuple:
+    """return (title, lyric) of a feed clip, lyric is prefixed with the title"""
+    title = clip.get("title") or ""
+    lyric = ""
+    mt = clip.get("metadata")
+    if isinstance(mt, dict) and mt.get("prompt"):
+        lyric = re.sub(r"\[.*?\]", "", mt.get("prompt"))
+    return title, f"{title}\n\n{lyric}" if title else lyric
+
+
+class _Pending:
+    __slots__ = ("future", "deadline")
+
+    def __init__(self, future: asyncio.Future, deadline: float):
+        self.future = future
+        self.deadline = deadline
+
+
+class ClipReadinessTracker:
+    """Poll /api/feed for in-flight clips and resolve one future per clip.
+
+    Clips tracked through the same client (one account) are merged into shared
+    feed requests. The poll interval starts at `min_interval`, grows by
+    `backoff` while nothing changes and falls back once a clip completes; every
+    sleep is jittered so workers of different accounts do not poll in lockstep.
+    A clip that is not complete after `timeout` seconds fails with TimeoutError.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 3,
+        max_interval: float = 20,
+        backoff: float = 1.5,
+        jitter: float = 0.2,
+        timeout: float = 600,
+        batch_size: int = 20,
+        max_failures: int = 6,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_failures = max_failures
+        self._pending = {}  # client -> {clip_id: _Pending}
+        self._pollers = {}  # client -> asyncio.Task
+
+    def track(self, client, clip_ids: list, timeout: float = None) -> list:
+        """register clip ids of `client` and return a future for each of them"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        pending = self._pending.setdefault(client, {})
+        futures = []
+        for clip_id in clip_ids:
+            if clip_id not in pending:
+                pending[clip_id] = _Pending(loop.create_future(), deadline)
+            futures.append(pending[clip_id].future)
+        poller = self._pollers.get(client)
+        if poller is None or poller.done():
+            self._pollers[client] = loop.create_task(self._poll(client))
+        return futures
+
+    async def wait(self, client, clip_ids: list, timeout: float = None) -> list:
+        """wait until all clips are complete, return the clips in the given order"""
+        futures = self.track(client, clip_ids, timeout)
+        try:
+            return await asyncio.gather(*futures)
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+
+    def discard(self, client, clip_ids: list):
+        """stop tracking clips nobody waits for any more"""
+        pending = self._pending.get(client, {})
+        for clip_id in clip_ids:
+            item = pending.pop(clip_id, None)
+            if item is not None:
+                item.future.cancel()
+
+    def _sleep_time(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _poll(self, client):
+        pending = self._pending[client]
+        interval = self.min_interval
+        failures = 0
+        try:
+            while pending:
+                await asyncio.sleep(self._sleep_time(interval))
+                self._drop_finished(pending)
+                if not pending:
+                    break
+                ids = list(pending)
+                progressed = False
+                try:
+                    for i in range(0, len(ids), self.batch_size):
+                        clips = await client.get_feed(ids[i: i + self.batch_size])
+                        progressed |= self._resolve(pending, clips)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    retries_total.inc(kind="feed")
+                    readiness_logger.warning(
+                        "poll feed failed (%s/%s): %s", failures, self.max_failures, e
+                    )
+                    if failures >= self.max_failures:
+                        self._fail_all(pending, e)
+                        break
+                    try:
+                        await client._renew()
+                    except Exception as e:
+                        readiness_logger.warning("renew failed: %s", e)
+                self._expire(pending)
+                if progressed:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+        except Exception as e:
+            readiness_logger.error("feed poller crashed: %s", e)
+            self._fail_all(pending, e)
+        finally:
+            if not pending:
+                self._pending.pop(client, None)
+                self._pollers.pop(client, None)
+
+    @staticmethod
+    def _drop_finished(pending: dict):
+        for clip_id in [k for k, v in pending.items() if v.future.done()]:
+            pending.pop(clip_id)
+
+    @staticmethod
+    def _resolve(pending: dict, clips: list) -> bool:
+        progressed = False
+        for clip in clips:
+            item = pending.get(clip.get("id"))
+            if item is None:
+                continue
+            status = clip.get("status")
+            if status == CLIP_COMPLETE:
+                item.future.set_result(clip)
+            elif status == CLIP_ERROR:
+                mt = clip.get("metadata") or {}
+                error = mt.get("error_message")
+                item.future.set_exception(
+                    Exception(f"clip {clip.get('id')} failed: {error}")
+                )
+            else:
+                continue
+            pending.pop(clip.get("id"))
+            progressed = True
+        return progressed
+
+    @staticmethod
+    def _expire(pending: dict):
+        now = time.monotonic()
+        for clip_id in [k for k, v in pending.items() if v.deadline < now]:
+            item = pending.pop(clip_id)
+            if not item.future.done():
+                item.future.set_exception(
+                    asyncio.TimeoutError(f"clip {clip_id} not ready in time")
+                )
+
+    @staticmethod
+    def _fail_all(pending: dict, exc: Exception):
+        for item in pending.values():
+            if not item.future.done():
+                item.future.set_exception(exc)
+        pending.clear()
+
+
+clip_tracker = ClipReadinessTracker()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/10
+# @FileName : session_cache.py
+# Created by; Andy963
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from utils.logger import FileSplitLogger
+from utils.metrics import cookie_failures
+from utils.suno import AsyncSongsGen
+
+cache_logger = FileSplitLogger("./logs/suno.log").logger
+
+
+class _CachedClient:
+    __slots__ = ("cookie_id", "client", "content", "users", "stale", "task")
+
+    def __init__(self, cookie_id: int, client: AsyncSongsGen, content: str):
+        self.cookie_id = cookie_id
+        self.client = client
+        self.content = content
+        self.users = 0
+        self.stale = False  # invalidated, closed once the last user releases it
+        self.task = None  # jwt refresher while in use, expiry timer while idle
+
+
+class SunoClientCache:
+    """Keep one logged in AsyncSongsGen (sid + jwt) per cookie.
+
+    The Clerk handshake is done once per cookie instead of once per request.
+    `acquire` hands out the client and `release` gives it back; while at least
+    one user holds it the jwt is renewed `refresh_margin` seconds before it
+    expires, an idle client is renewed lazily by the next `acquire` and closed
+    once its jwt lapses unused. An invalidated client is dropped from the
+    cache at once but only closed when its last user released it, so e.g. a
+    failed probe does not break the clips still polled through it.
+    """
+
+    def __init__(self, refresh_margin: float = 15):
+        self.refresh_margin = refresh_margin
+        self._clients = {}  # cookie id -> _CachedClient
+        self._entries = {}  # AsyncSongsGen -> _CachedClient, held ones included
+        self._locks = {}  # cookie id -> asyncio.Lock
+
+    async def acquire(self, cookie_id: int, content: str) -> AsyncSongsGen:
+        """return a warm client for the cookie, login if needed"""
+        lock = self._locks.setdefault(cookie_id, asyncio.Lock())
+        async with lock:
+            cached = self._clients.get(cookie_id)
+            if cached is not None and cached.content != content:
+                await self.invalidate(cookie_id)
+                cached = None
+            if cached is None:
+                client = AsyncSongsGen(content, cookie_id=cookie_id)
+                try:
+                    await client.login()
+                except BaseException:
+                    # also a login cancelled by a caller's timeout
+                    await client.close()
+                    raise
+                cached = _CachedClient(cookie_id, client, content)
+                self._clients[cookie_id] = cached
+                self._entries[client] = cached
+            elif cached.client.jwt_expire - time.time() < self.refresh_margin:
+                await cached.client._renew()
+            cached.users += 1
+            if cached.users == 1:
+                self._set_task(cached, self._refresh(cached))
+            return cached.client
+
+    async def release(self, client: AsyncSongsGen):
+        cached = self._entries.get(client)
+        if cached is None:
+            return
+        cached.users = max(cached.users - 1, 0)
+        if cached.users:
+            return
+        if cached.stale:
+            await self._close(cached)
+        else:
+            self._set_task(cached, self._expire(cached))
+
+    @asynccontextmanager
+    async def client(self, cookie_id: int, content: str):
+        """async with client_cache.client(id, content) as sg: ..."""
+        client = await self.acquire(cookie_id, content)
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    async def invalidate(self, cookie_id: int):
+        """drop the cached client, e.g. after the cookie failed to authenticate"""
+        cached = self._clients.pop(cookie_id, None)
+        if cached is None:
+            return
+        cached.stale = True
+        if not cached.users:
+            await self._close(cached)
+
+    async def close(self):
+        for cached in list(self._entries.values()):
+            self._clients.pop(cached.cookie_id, None)
+            await self._close(cached)
+
+    def _set_task(self, cached: _CachedClient, coro):
+        if cached.task and cached.task is not asyncio.current_task():
+            cached.task.cancel()
+        cached.task = asyncio.create_task(coro)
+
+    async def _close(self, cached: _CachedClient):
+        self._entries.pop(cached.client, None)
+        if self._clients.get(cached.cookie_id) is cached:
+            self._clients.pop(cached.cookie_id)
+        if cached.task and cached.task is not asyncio.current_task():
+            cached.task.cancel()
+        await cached.client.close()
+
+    async def _refresh(self, cached: _CachedClient):
+        """renew the jwt of a client in use before it expires"""
+        while cached.users:
+            wait = cached.client.jwt_expire - time.time() - self.refresh_margin
+            await asyncio.sleep(max(wait, 1))
+            if cached.client.jwt_expire - time.time() > self.refresh_margin:
+                # renewed inline by acquire meanwhile
+                continue
+            try:
+                await cached.client._renew()
+            except Exception as e:
+                cache_logger.warning(
+                    f"Cookie: {cached.cookie_id} renew jwt failed: {e}"
+                )
+                cookie_failures.inc(reason="renew")
+            if cached.client.jwt_expire <= time.time():
+                if self._clients.get(cached.cookie_id) is cached:
+                    await self.invalidate(cached.cookie_id)
+                return
+
+    async def _expire(self, cached: _CachedClient):
+        await asyncio.sleep(max(cached.client.jwt_expire - time.time(), 0))
+        if not cached.users:
+            cache_logger.info(f"Cookie: {cached.cookie_id} client idle, closed")
+            await self._close(cached)
+
+
+client_cache = SunoClientCache()
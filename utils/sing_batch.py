@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/28
+# @FileName : sing_batch.py
+# Created by; Andy963
+import asyncio
+import time
+
+import config
+from db import adb, GenerationJob
+from utils.cookie_pool import cookie_pool
+from utils.generation import generation_queue
+from utils.logger import FileSplitLogger
+
+batch_logger = FileSplitLogger("./logs/bot.log").logger
+
+
+def parse_prompts(text: str) -> list:
+    """one prompt per line, blank and # lines are skipped"""
+    prompts = []
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) < 2 or line.startswith("#"):
+            continue
+        prompts.append(line)
+    return prompts
+
+
+class SingBatch:
+    """Many /sing prompts queued at once and followed until they finish.
+
+    Only as many prompts as the cookies have credits for are queued, the rest
+    are skipped. The queue is scaled to one worker per cookie slot, so the
+    prompts run in parallel over the whole pool; each song is delivered to
+    the chat as soon as its clips are ready, like a single /sing. `wait`
+    follows the jobs through the table, which also covers jobs run by
+    another bot worker, and scales the queue back when it returns.
+    """
+
+    def __init__(self, tg_id, chat_id: int, prompts: list):
+        self.tg_id = tg_id
+        self.chat_id = chat_id
+        self.prompts = prompts
+        self.jobs = []  # GenerationJob, in prompt order
+        self.skipped = []
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.workers = None  # the queue's worker count asked for by the batch
+
+    async def submit(self) -> str:
+        await cookie_pool.refresh(force=True)
+        left = await adb.get_left_count()
+        queued, self.skipped = self.prompts[:left], self.prompts[left:]
+        self.workers = min(cookie_pool.capacity(), config.batch_max_workers)
+        generation_queue.scale(self.workers)
+        try:
+            for prompt in queued:
+                self.jobs.append(
+                    await generation_queue.submit(self.tg_id, self.chat_id, prompt)
+                )
+        except BaseException:
+            # nobody will wait for the batch, hand the workers back
+            generation_queue.unscale(self.workers)
+            self.workers = None
+            raise
+        batch_logger.info(
+            f"batch of {len(self.prompts)} prompts: jobs "
+            f"{[j.id for j in self.jobs]}, {len(self.skipped)} skipped"
+        )
+        text = (
+            f"Singing {len(self.jobs)} songs on {generation_queue.workers} "
+            f"workers, songs are sent as they finish."
+        )
+        if self.skipped:
+            text += f" {len(self.skipped)} prompts skipped, not enough credits."
+        return text
+
+    async def wait(self, poll_interval: float = 5, timeout: float = None):
+        """until every job is done or failed, or `timeout` seconds passed"""
+        pending = {j.id: j for j in self.jobs}
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            while pending:
+                await asyncio.sleep(poll_interval)
+                for job in await adb.get_jobs(list(pending)):
+                    if job.status in GenerationJob.FINISHED:
+                        pending.pop(job.id)
+                        self.jobs = [job if j.id == job.id else j for j in self.jobs]
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+        finally:
+            if self.workers is not None:
+                generation_queue.unscale(self.workers)
+                self.workers = None
+        self.elapsed = time.monotonic() - self.started
+
+    def summary(self) -> list:
+        counts = {}
+        lines = []
+        for index, job in enumerate(self.jobs, 1):
+            status = job.status
+            counts[status] = counts.get(status, 0) + 1
+            line = f"#{index} job {job.id} {status}"
+            if job.song_id is not None:
+                line += f", song {job.song_id}"
+            if job.error:
+                line += f": {job.error}"
+            lines.append(f"{line}: {job.prompt}"[:200])
+        for prompt in self.skipped:
+            lines.append(f"skipped: {prompt}"[:200])
+        done = counts.get(GenerationJob.DONE, 0)
+        elapsed = self.elapsed or time.monotonic() - self.started
+        lines.append(
+            f"Batch: {len(self.prompts)} prompts, {done} done, "
+            f"{counts.get(GenerationJob.FAILED, 0)} failed, "
+            f"{len(self.jobs) - done - counts.get(GenerationJob.FAILED, 0)} "
+            f"unfinished, {len(self.skipped)} skipped in {elapsed:.0f}s "
+            f"({done / elapsed * 60:.1f} songs/minute)"
+        )
+        return lines
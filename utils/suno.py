@@ -1,7 +1,9 @@
+import base64
 import json
 import re
 import time
 from datetime import datetime
+from functools import partial
 from http.cookies import SimpleCookie
 
 from curl_cffi import requests
@@ -9,6 +11,12 @@ from curl_cffi.requests import Cookies
 from rich import print
 
 from utils.logger import FileSplitLogger
+from utils.metrics import (
+    retries_total, suno_request_errors, suno_request_seconds, timed
+)
+from utils.ratelimit import UpstreamError, breaker, is_failure, rate_limiter
+from utils.readiness import clip_tracker, clip_title_lyric
+from utils.transport import transport
 
 ua = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)"
@@ -21,6 +29,10 @@ exchange_token_url = (
 )
 
 base_url = "https://app.suno.ai"
+studio_api_url = "https://studio-api.suno.ai"
+generate_url = studio_api_url + "/api/generate/v2/"
+feed_url = studio_api_url + "/api/feed/?ids={ids}"
+billing_url = studio_api_url + "/api/billing/info/"
 browser_version = "edge101"
 
 HEADERS = {
@@ -37,6 +49,30 @@ HEADERS = {
 
 suno_logger = FileSplitLogger("./logs/suno.log").logger
 
+# time the http calls and count the failed ones, by method
+api_timed = partial(timed, suno_request_seconds, suno_request_errors)
+
+
+def jwt_expire_at(jwt: str, default_ttl: int = 60) -> float:
+    """unix timestamp the jwt expires at, clerk tokens live for 60s by default"""
+    try:
+        payload = jwt.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + default_ttl
+
+
+class AuthError(Exception):
+    """the cookie has no active clerk session, it has to be replaced"""
+
+
+def is_auth_failure(error: Exception) -> bool:
+    """whether the account itself was rejected, not just the request"""
+    if isinstance(error, UpstreamError):
+        return error.status in (401, 403)
+    return isinstance(error, AuthError)
+
 
 class SongsGen:
     def __init__(self, cookie: str) -> None:
@@ -49,6 +85,7 @@ class SongsGen:
         self.session.headers = HEADERS
         self.sid = None
 
+    @api_timed(method="_get_auth_token")
     def _get_auth_token(self):
         response = self.session.get(get_session_url, impersonate=browser_version)
         data = response.json()
@@ -58,7 +95,7 @@ class SongsGen:
             sid = r.get("last_active_session_id")
         if not sid:
             suno_logger.warning("Failed to get session id")
-            raise Exception("Failed to get session id")
+            raise AuthError("Failed to get session id")
         self.sid = sid
         response = self.session.post(
             exchange_token_url.format(sid=sid), impersonate=browser_version
@@ -66,6 +103,7 @@ class SongsGen:
         data = response.json()
         return data.get("jwt")
 
+    @api_timed(method="get_session_expire_date")
     def get_session_expire_date(self) -> [datetime, None]:
         # for Setting both the 'Origin' and 'Authorization' headers is forbidden
         origin = None
@@ -82,10 +120,11 @@ class SongsGen:
             expire_at = sessions.get("expire_at")
             return datetime.fromtimestamp(int(expire_at) / 1000)
 
+    @api_timed(method="_renew")
     def _renew(self):
         origin = None
-        if 'Origin' in  self.session.headers:
-            origin = self.session.pop('Origin')
+        if 'Origin' in self.session.headers:
+            origin = self.session.headers.pop('Origin')
         response = self.session.post(
             exchange_token_url.format(sid=self.sid), impersonate=browser_version
         )
@@ -106,42 +145,47 @@ class SongsGen:
             cookies_dict[key] = morsel.value
         return Cookies(cookies_dict)
 
+    @api_timed(method="get_limit_left")
     def get_limit_left(self) -> int:
         self.session.headers["user-agent"] = ua
-        r = self.session.get(
-            "https://studio-api.suno.ai/api/billing/info/", impersonate=browser_version
-        )
+        r = self.session.get(billing_url, impersonate=browser_version)
         return int(r.json()["total_credits_left"] / 10)
 
-    def _fetch_songs_metadata(self, ids, retry_count=0, max_retries=6):
+    def _fetch_songs_metadata(self, ids, max_retries=6):
         id1, id2 = ids[:2]
-        rs = {"song_name": "", "lyric": "", "song_ids": []}
-        url = f"https://studio-api.suno.ai/api/feed/?ids={id1}%2C{id2}"
-        response = self.session.get(url, impersonate=browser_version)
-        try:
-            data = response.json()
-            for d in data:
-                if len(rs["song_ids"]) != 2 and (s_id := d.get("id")):
-                    rs["song_ids"].append(s_id)
-                mt = d.get("metadata")
-                if not rs["lyric"] and isinstance(mt, dict):
-                    rs["lyric"] = re.sub(r"\[.*?\]", "", mt.get("prompt"))
-                if not rs["song_name"] and d.get("title"):
-                    rs["song_name"] = d.get("title")
+        url = feed_url.format(ids=f"{id1}%2C{id2}")
+        for _ in range(max_retries):
+            rs = {"song_name": "", "lyric": "", "song_ids": []}
+            try:
+                response = self.session.get(url, impersonate=browser_version)
+                if not response.ok:
+                    raise Exception(f"Error response {str(response)}")
+                for d in response.json():
+                    if len(rs["song_ids"]) != 2 and (s_id := d.get("id")):
+                        rs["song_ids"].append(s_id)
+                    mt = d.get("metadata")
+                    if not rs["lyric"] and isinstance(mt, dict):
+                        rs["lyric"] = re.sub(r"\[.*?\]", "", mt.get("prompt"))
+                    if not rs["song_name"] and d.get("title"):
+                        rs["song_name"] = d.get("title")
+            except Exception as e:
+                suno_logger.warning("fetch songs metadata exception: %s", e)
+                retries_total.inc(kind="feed")
+                try:
+                    self._renew()
+                except Exception as e:
+                    suno_logger.warning("renew failed: %s", e)
+                time.sleep(2)
+                continue
             if all(rs.values()):
                 rs["lyric"] = rs["song_name"] + "\n\n" + rs["lyric"]
                 return rs
-            else:
-                time.sleep(10)
-                return self._fetch_songs_metadata(ids, retry_count)
-        except Exception as e:
-            suno_logger.warning("fetch songs metadata exception: %s", e)
-            self._renew()
-            time.sleep(2)
-            return self._fetch_songs_metadata(ids, retry_count + 1, max_retries)
+            retries_total.inc(kind="feed")
+            time.sleep(10)
+        raise Exception(f"songs {ids} not ready after {max_retries} retries")
 
     def get_songs_info(self, prompt: str) -> dict:
-        url = "https://studio-api.suno.ai/api/generate/v2/"
+        url = generate_url
         self.session.headers["user-agent"] = ua
         payload = {
             "gpt_description_prompt": prompt,
@@ -161,3 +205,151 @@ class SongsGen:
         songs_meta_info = response_body["clips"]
         request_ids = [i["id"] for i in songs_meta_info]
         return self._fetch_songs_metadata(request_ids)
+
+
+class AsyncSongsGen:
+    """asyncio version of SongsGen with one AsyncSession per account, on the
+    process wide transport so connections are shared between accounts.
+
+    Every request waits for its endpoint's rate limiter; failed responses
+    raise UpstreamError and count against the breaker of `cookie_id`.
+
+    usage:
+        async with AsyncSongsGen(cookie) as sg:
+            info = await sg.get_songs_info(prompt)
+    """
+
+    def __init__(
+        self, cookie: str, max_clients: int = 10, cookie_id: int = None
+    ) -> None:
+        self.cookie = cookie
+        self.cookie_id = cookie_id
+        self.sid = None
+        self.jwt = None
+        self.jwt_expire = 0
+        self.session = transport.session(
+            max_clients=max_clients, impersonate=browser_version
+        )
+        self.session.cookies = SongsGen.parse_cookie_string(cookie)
+        # Clerk forbids sending both 'Origin' and 'Authorization', so the
+        # session keeps neutral headers and studio-api calls add them per request
+        self.session.headers = {
+            k: v for k, v in HEADERS.items() if k not in ("Origin", "Authorization")
+        }
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def login(self):
+        self.jwt = await self._get_auth_token()
+        self.jwt_expire = jwt_expire_at(self.jwt)
+
+    async def close(self):
+        await self.session.close()
+
+    def _studio_headers(self) -> dict:
+        return {"Origin": base_url, "Authorization": f"Bearer {self.jwt}"}
+
+    async def _request(self, endpoint: str, method: str, url: str, **kwargs):
+        await rate_limiter.acquire(endpoint)
+        response = await self.session.request(method, url, **kwargs)
+        if is_failure(response.status_code):
+            breaker.failure(self.cookie_id, response.status_code)
+            raise UpstreamError(endpoint, response.status_code, response.text)
+        if response.ok:
+            breaker.success(self.cookie_id)
+        return response
+
+    @api_timed(method="_get_auth_token")
+    async def _get_auth_token(self):
+        response = await self._request("clerk", "GET", get_session_url)
+        data = response.json()
+        r = data.get("response")
+        sid = None
+        if r:
+            sid = r.get("last_active_session_id")
+        if not sid:
+            suno_logger.warning("Failed to get session id")
+            raise AuthError("Failed to get session id")
+        self.sid = sid
+        response = await self._request(
+            "clerk", "POST", exchange_token_url.format(sid=sid)
+        )
+        data = response.json()
+        return data.get("jwt")
+
+    @api_timed(method="get_session_expire_date")
+    async def get_session_expire_date(self) -> [datetime, None]:
+        response = await self._request("clerk", "GET", get_session_url)
+        data = response.json()
+        r = data.get("response")
+        if r and r.get("sessions"):
+            sessions = r.get("sessions")[0]
+            expire_at = sessions.get("expire_at")
+            return datetime.fromtimestamp(int(expire_at) / 1000)
+
+    @api_timed(method="_renew")
+    async def _renew(self):
+        response = await self._request(
+            "clerk", "POST", exchange_token_url.format(sid=self.sid)
+        )
+        resp = response.json()
+        if "jwt" in resp.keys():
+            self.jwt = resp.get("jwt")
+            self.jwt_expire = jwt_expire_at(self.jwt)
+        else:
+            suno_logger.warning("renew no jwt in resp, with resp: %s", resp)
+
+    @api_timed(method="get_limit_left")
+    async def get_limit_left(self) -> int:
+        r = await self._request(
+            "billing", "GET", billing_url, headers=self._studio_headers()
+        )
+        return int(r.json()["total_credits_left"] / 10)
+
+    @api_timed(method="get_feed")
+    async def get_feed(self, ids: list) -> list:
+        url = feed_url.format(ids="%2C".join(ids))
+        response = await self._request(
+            "feed", "GET", url, headers=self._studio_headers()
+        )
+        return response.json()
+
+    async def _fetch_songs_metadata(self, ids, timeout: float = None):
+        clips = await clip_tracker.wait(self, ids[:2], timeout)
+        song_name, lyric = clip_title_lyric(clips[0])
+        return {
+            "song_name": song_name,
+            "lyric": lyric,
+            "song_ids": [c["id"] for c in clips],
+        }
+
+    @api_timed(method="generate")
+    async def generate(self, prompt: str, mv: str = "chirp-v3-0") -> list:
+        """submit a generation, return the clip ids"""
+        payload = {
+            "gpt_description_prompt": prompt,
+            "mv": mv,
+            "prompt": "",
+            "make_instrumental": False,
+        }
+        response = await self._request(
+            "generate",
+            "POST",
+            generate_url,
+            data=json.dumps(payload),
+            headers=self._studio_headers(),
+        )
+        if not response.ok:
+            suno_logger.warning("generate failed: %s", response.text)
+            raise Exception(f"Error response {str(response)}")
+        response_body = response.json()
+        return [i["id"] for i in response_body["clips"]]
+
+    async def get_songs_info(self, prompt: str) -> dict:
+        request_ids = await self.generate(prompt)
+        return await self._fetch_songs_metadata(request_ids)
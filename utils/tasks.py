@@ -3,72 +3,142 @@
 # @Date     : 2024/3/28
 # @FileName : tasks.py # noqa
 # Created by; Andy963
+import asyncio
+import time
 from datetime import date
 
 from aiogram import Bot
 
 import config
-from db import db
+from db import adb
 from utils.logger import FileSplitLogger
-from utils.suno import SongsGen
+from utils.metrics import cookie_failures
+from utils.session_cache import client_cache
+from utils.suno import is_auth_failure
 
 task_logger = FileSplitLogger("./logs/tasks.log").logger
 
 
-async def update_session_date(bot: Bot):
-    task_logger.info("update cookie session start:")
-    cks = db.get_all_cookie()
-    msg = []
-    for ck in cks:
-        sg = SongsGen(ck.content)
-        rs = sg.get_session_expire_date()
-        msg_ = (
-            f"Cookie: {ck.id} session updated and will expired at "
-            f"{rs.strftime('%Y-%m-%d %H:%M:%S')}"
+class ProbeResult:
+    __slots__ = ("cookie", "value", "error")
+
+    def __init__(self, cookie, value=None, error: Exception = None):
+        self.cookie = cookie
+        self.value = value
+        self.error = error
+
+
+async def probe_cookies(cks, probe, concurrency: int = None, timeout: float = None):
+    """run `await probe(client)` for every cookie concurrently.
+
+    At most `concurrency` cookies are checked at the same time and each one is
+    given `timeout` seconds; a failing cookie is reported in its ProbeResult
+    instead of aborting the whole run.
+    """
+    semaphore = asyncio.Semaphore(concurrency or config.task_concurrency)
+    timeout = timeout or config.task_timeout
+
+    async def _probe(ck):
+        async with semaphore:
+            sg = None
+            try:
+                sg = await asyncio.wait_for(
+                    client_cache.acquire(ck.id, ck.content), timeout
+                )
+                return ProbeResult(ck, await asyncio.wait_for(probe(sg), timeout))
+            except Exception as e:
+                task_logger.warning(f"Cookie: {ck.id} probe failed: {e!r}")
+                cookie_failures.inc(reason="probe")
+                # running jobs may share the client, keep it over a hiccup
+                if is_auth_failure(e):
+                    await client_cache.invalidate(ck.id)
+                return ProbeResult(ck, error=e)
+            finally:
+                if sg is not None:
+                    await client_cache.release(sg)
+
+    return await asyncio.gather(*[_probe(ck) for ck in cks])
+
+
+def _summary(title: str, results: list, started: float) -> str:
+    failed = sum(1 for r in results if r.error is not None)
+    return (
+        f"{title}: {len(results)} cookies, {failed} failed, "
+        f"took {time.monotonic() - started:.1f}s"
+    )
+
+
+async def _report(bot: Bot, msg: list):
+    if msg:
+        await bot.send_message(
+            config.bot_id,
+            "\n".join(msg),
+            disable_notification=True,
         )
-        task_logger.info(msg_)
-        msg.append(msg_)
-        if rs:
-            db.update_session_expired(ck.id, rs)
-    await bot.send_message(
-        config.bot_id,
-        "\n".join(msg),
-        disable_notification=True,
+
+
+async def probe_health(sg) -> dict:
+    """everything the daily probe needs from one (cached) auth handshake"""
+    session_expired, left_counts = await asyncio.gather(
+        sg.get_session_expire_date(), sg.get_limit_left()
     )
+    return {"session_expired": session_expired, "left_counts": left_counts}
 
 
-async def update_cookie_left_count(bot: Bot):
-    task_logger.info("update cookie left count start:")
-    cks = db.get_all_cookie()
+async def probe_cookie_health(bot: Bot):
+    """refresh session expiry, credits and auth validity of every cookie.
+
+    One pass replaces the former update_session_date, update_cookie_left_count
+    and notify_session_expire jobs: all fields are persisted together and the
+    expiry notification is derived from the stored snapshot.
+    """
+    task_logger.info("cookie health probe start:")
+    started = time.monotonic()
+    results = await probe_cookies(await adb.get_all_cookie(), probe_health)
     msg = []
-    for ck in cks:
-        sg = SongsGen(ck.content)
-        rs = sg.get_limit_left()
-        db.update_cookie(ck.id, left_counts=rs)
-        msg_ = f"Cookie: {ck.id} left count updated to {rs}"
+    rows = []
+    upstream = {}
+    for r in results:
+        if r.error is not None and is_auth_failure(r.error):
+            msg_ = f"Cookie: {r.cookie.id} auth failed: {r.error!r}"
+            rows.append({"id": r.cookie.id, "is_valid": False})
+        elif r.error is not None:
+            # timeouts, 429 and 5xx say nothing about the cookie, keep its flag
+            msg_ = f"Cookie: {r.cookie.id} probe failed: {r.error!r}"
+        else:
+            row = {"id": r.cookie.id, "is_valid": True}
+            upstream[r.cookie.id] = r.value["left_counts"]
+            expired = r.value["session_expired"]
+            if expired is not None:
+                row["session_expired"] = expired
+            rows.append(row)
+            expired = expired.strftime("%Y-%m-%d %H:%M:%S") if expired else "unknown"
+            msg_ = (
+                f"Cookie: {r.cookie.id} left count {r.value['left_counts']}, "
+                f"session will expired at {expired}"
+            )
         task_logger.info(msg_)
         msg.append(msg_)
-    await bot.send_message(
-        config.bot_id,
-        "\n".join(msg),
-        disable_notification=True,
-    )
+    await adb.bulk_update_cookies(rows)
+    await adb.reconcile_credits(upstream)
+    today = date.today()
+    for ck in await adb.get_all_cookie():
+        if ck.session_expired and ck.session_expired.date() == today:
+            msg.append(f"Cookie: {ck.id} will expire today")
+    summary = _summary("cookie health probe", results, started)
+    task_logger.info(summary)
+    msg.append(summary)
+    await _report(bot, msg)
 
 
-async def notify_session_expire(bot: Bot):
-    task_logger.info("notify session expire start:")
-    cks = db.get_all_cookie()
-    msg = []
-    today = date.today()
-    for ck in cks:
-        sg = SongsGen(ck.content)
-        rs = sg.get_session_expire_date()
-        if rs:
-            if rs.date() == today:
-                msg_ = f"Cookie: {ck.id} will expire today"
-                msg.append(msg_)
-    await bot.send_message(
-        config.bot_id,
-        "\n".join(msg),
-        disable_notification=True,
+async def reconcile_credits():
+    """correct the ledger counts of valid cookies with the upstream credits"""
+    cks = [ck for ck in await adb.get_all_cookie() if ck.is_valid is not False]
+    started = time.monotonic()
+    results = await probe_cookies(cks, lambda sg: sg.get_limit_left())
+    drift = await adb.reconcile_credits(
+        {r.cookie.id: r.value for r in results if r.error is None}
     )
+    for cookie_id, left_counts in drift.items():
+        task_logger.info(f"Cookie: {cookie_id} left count reconciled to {left_counts}")
+    task_logger.info(_summary("credit reconcile", results, started))
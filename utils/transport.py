@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Date     : 2024/4/30
+# @FileName : transport.py
+# Created by; Andy963
+import asyncio
+import time
+from functools import partialmethod
+from urllib.parse import urlsplit
+
+from curl_cffi import CurlInfo, ffi
+from curl_cffi.aio import AsyncCurl
+from curl_cffi.const import CurlHttpVersion, CurlMOpt
+from curl_cffi.requests import AsyncSession
+
+import config
+from utils.metrics import registry
+
+http_requests = registry.counter(
+    "http_requests_total", "upstream requests by pool and connection new/reused"
+)
+
+
+class PoolStats:
+    """Requests and newly opened connections per host of a connection pool.
+
+    Connections are told apart by their local port; one used within
+    `idle_ttl` seconds counts as open, libcurl closes idle connections after
+    118 seconds by default.
+    """
+
+    def __init__(self, pool: str, idle_ttl: float = 118):
+        self.pool = pool
+        self.idle_ttl = idle_ttl
+        self._hosts = {}  # host -> [requests, new connections]
+        self._connections = {}  # (host, local port) -> last used
+
+    def record(self, host: str, new_connection: bool, local_port: int = None):
+        counts = self._hosts.setdefault(host, [0, 0])
+        counts[0] += 1
+        counts[1] += new_connection
+        http_requests.inc(
+            pool=self.pool, connection="new" if new_connection else "reused"
+        )
+        if local_port:
+            self._connections[(host, local_port)] = time.monotonic()
+
+    def open_connections(self) -> int:
+        now = time.monotonic()
+        for key, used in list(self._connections.items()):
+            if now - used > self.idle_ttl:
+                self._connections.pop(key)
+        return len(self._connections)
+
+    def stats(self) -> dict:
+        requests = sum(c[0] for c in self._hosts.values())
+        connects = sum(c[1] for c in self._hosts.values())
+        stats = {
+            "requests": requests,
+            "connects": connects,
+            "reuse": round(1 - connects / requests, 3) if requests else 0,
+            "hosts": {h: f"{c[0]} req / {c[1]} new" for h, c in self._hosts.items()},
+        }
+        if self._connections:
+            stats["open"] = self.open_connections()
+        return stats
+
+
+class SharedSession(AsyncSession):
+    """AsyncSession on the process wide curl multi handle.
+
+    The session keeps its own cookies, headers and easy handles, so accounts
+    never see each other's auth. Closing it leaves the shared handle open.
+    """
+
+    def __init__(self, transport: "Transport", **kwargs):
+        super().__init__(
+            curl_infos=[CurlInfo.NUM_CONNECTS, CurlInfo.LOCAL_PORT], **kwargs
+        )
+        self.transport = transport
+
+    @property
+    def acurl(self) -> AsyncCurl:
+        return self.transport.acurl()
+
+    async def request(self, method: str, url: str, *args, **kwargs):
+        response = await super().request(method, url, *args, **kwargs)
+        self.transport.pool_stats.record(
+            urlsplit(url).netloc,
+            bool(response.infos.get(CurlInfo.NUM_CONNECTS)),
+            response.infos.get(CurlInfo.LOCAL_PORT),
+        )
+        return response
+
+    # the base class binds these to its own request
+    head = partialmethod(request, "HEAD")
+    get = partialmethod(request, "GET")
+    post = partialmethod(request, "POST")
+    put = partialmethod(request, "PUT")
+    patch = partialmethod(request, "PATCH")
+    delete = partialmethod(request, "DELETE")
+    options = partialmethod(request, "OPTIONS")
+
+    async def close(self):
+        self._closed = True
+        while True:
+            try:
+                curl = self.pool.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if curl:
+                curl.close()
+
+
+class Transport:
+    """Process wide keep-alive connections for the clerk and studio-api clients.
+
+    libcurl keeps its connection cache on the multi handle, so with one
+    AsyncCurl shared by every SharedSession a connection, and its TLS session,
+    opened for one account is reused by the next request of any account.
+    `max_connections` idle connections are kept alive, `max_host_connections`
+    limits the connections per host, 0 is unlimited. `http_version` pins the
+    protocol of every session, None lets libcurl negotiate.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_host_connections: int = 0,
+        http_version: CurlHttpVersion = None,
+    ):
+        self.max_connections = max_connections
+        self.max_host_connections = max_host_connections
+        self.http_version = http_version
+        self.pool_stats = PoolStats("suno")
+        self._acurl = None
+        self._loop = None
+
+    def acurl(self) -> AsyncCurl:
+        loop = asyncio.get_running_loop()
+        if self._acurl is None or self._loop is not loop:
+            # an AsyncCurl is bound to the loop it was created in
+            self._acurl = AsyncCurl(loop=loop)
+            # curl_multi_setopt is variadic, the long goes through its void *
+            self._acurl.setopt(
+                CurlMOpt.MAXCONNECTS, ffi.cast("void *", self.max_connections)
+            )
+            self._acurl.setopt(
+                CurlMOpt.MAX_HOST_CONNECTIONS,
+                ffi.cast("void *", self.max_host_connections),
+            )
+            self._loop = loop
+        return self._acurl
+
+    def session(self, **kwargs) -> SharedSession:
+        kwargs.setdefault("http_version", self.http_version)
+        return SharedSession(self, **kwargs)
+
+    def stats(self) -> dict:
+        return self.pool_stats.stats()
+
+    async def close(self):
+        if self._acurl is not None:
+            await self._acurl.close()
+            self._acurl = None
+            self._loop = None
+
+
+transport = Transport(
+    max_connections=config.transport_max_connections,
+    max_host_connections=config.transport_max_host_connections,
+)